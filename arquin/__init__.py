@@ -1,5 +1,59 @@
-from arquin.device import Device
-from arquin.module import Module
-from arquin import converters
-from arquin.modular_compiler import ModularCompiler
-from arquin import distribute
\ No newline at end of file
+"""
+Submodules and their heavy dependencies (qiskit, networkx, matplotlib) are imported lazily,
+on first attribute access, so that processes only pay for what they use.
+"""
+
+import importlib
+import threading
+from typing import Any, List
+
+SUBMODULES = [
+    "comms",
+    "converters",
+    "device",
+    "distribute",
+    "encoding",
+    "ingest",
+    "metrics",
+    "modular_compiler",
+    "module",
+    "optimize",
+    "partitioner",
+    "schedule",
+    "verify",
+    "visualize",
+]
+ATTRIBUTES = {
+    "Device": "device",
+    "Module": "module",
+    "ModularCompiler": "modular_compiler",
+}
+
+
+def __getattr__(name: str) -> Any:
+    if name in ATTRIBUTES:
+        value = getattr(importlib.import_module("arquin." + ATTRIBUTES[name]), name)
+    elif name in SUBMODULES:
+        value = importlib.import_module("arquin." + name)
+    else:
+        raise AttributeError("module 'arquin' has no attribute '%s'" % name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(set(SUBMODULES) | set(ATTRIBUTES) | {"preload"})
+
+
+def preload(*names: str) -> threading.Thread:
+    """
+    Import the given submodules, or all the compiler submodules, in a background thread.
+    Lets the imports overlap with other startup work, e.g. reading the input circuit.
+    """
+    if len(names) == 0:
+        names = ("converters", "device", "distribute", "modular_compiler", "module")
+    thread = threading.Thread(
+        target=lambda: [importlib.import_module("arquin." + name) for name in names], daemon=True
+    )
+    thread.start()
+    return thread
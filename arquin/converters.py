@@ -1,7 +1,10 @@
+import itertools
+import os
 import subprocess
-from typing import Dict, Iterable, List, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import networkx as nx
+import numpy as np
 import qiskit
 
 
@@ -44,30 +47,108 @@ def edges_to_source_graph(edges, vertex_weights: Dict) -> Dict:
     return source_graph
 
 
-def circuit_to_graph(circuit):
-    dag = qiskit.converters.circuit_to_dag(circuit)
-    vertex_weights = []
-    id_to_idx = {}  # Gate id to gate idx
-    idx_to_gate = []  # Gates in topological order
-    dirty_qubits = []
-    for vertex in dag.topological_op_nodes():
-        id_to_idx[id(vertex)] = len(idx_to_gate)
-        idx_to_gate.append(vertex)
-        vertex_weight = 0
-        for qarg in vertex.qargs:
-            if qarg not in dirty_qubits:
-                dirty_qubits.append(qarg)
-                vertex_weight += 1
-        vertex_weights.append(vertex_weight)
-
-    edges = []
-    for u, v, _ in dag.edges():
-        if u.type == "op" and v.type == "op":
-            u_idx = id_to_idx[id(u)]
-            v_idx = id_to_idx[id(v)]
-            edges.append((u_idx, v_idx))
-
-    return vertex_weights, edges
+def circuit_to_gate_arrays(circuit: qiskit.QuantumCircuit) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Flatten the wires of every instruction in ``circuit.data`` into CSR arrays.
+    Qubits are numbered 0..num_qubits-1 and clbits follow from num_qubits onwards.
+    The wires of gate i are wires[wire_offsets[i] : wire_offsets[i + 1]].
+    """
+    wire_to_idx = {qubit: idx for idx, qubit in enumerate(circuit.qubits)}
+    wire_to_idx.update(
+        {clbit: circuit.num_qubits + idx for idx, clbit in enumerate(circuit.clbits)}
+    )
+    gate_wires = [(*instruction.qubits, *instruction.clbits) for instruction in circuit.data]
+    wire_offsets = np.zeros(len(gate_wires) + 1, dtype=np.int64)
+    np.cumsum([len(bits) for bits in gate_wires], out=wire_offsets[1:])
+    wires = np.fromiter(
+        map(wire_to_idx.__getitem__, itertools.chain.from_iterable(gate_wires)),
+        dtype=np.int64,
+        count=wire_offsets[-1],
+    )
+    return wire_offsets, wires
+
+
+def gate_arrays_to_graph(
+    wire_offsets: np.ndarray, wires: np.ndarray, num_qubits: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build the gate dependency graph from the CSR gate arrays.
+    Every pair of consecutive gates on a wire contributes one edge, same as the DAG edges.
+    The weight of a gate is the number of qubits it touches first.
+    """
+    num_gates = len(wire_offsets) - 1
+    gate_indices = np.repeat(np.arange(num_gates, dtype=np.int64), np.diff(wire_offsets))
+    # Stable sort by wire keeps the gates on each wire in circuit order
+    order = np.argsort(wires, kind="stable")
+    sorted_wires = wires[order]
+    sorted_gates = gate_indices[order]
+    same_wire = sorted_wires[1:] == sorted_wires[:-1]
+    edges = np.stack([sorted_gates[:-1][same_wire], sorted_gates[1:][same_wire]], axis=1)
+
+    first_on_wire = np.ones(len(sorted_wires), dtype=bool)
+    first_on_wire[1:] = ~same_wire
+    first_on_qubit = first_on_wire & (sorted_wires < num_qubits)
+    vertex_weights = np.bincount(sorted_gates[first_on_qubit], minlength=num_gates)
+    return vertex_weights, edges.reshape(-1, 2)
+
+
+def circuit_to_graph(circuit: qiskit.QuantumCircuit) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gate dependency graph of the circuit without going through a qiskit DAG.
+    Gates are indexed in ``circuit.data`` order, which is a topological order.
+    """
+    wire_offsets, wires = circuit_to_gate_arrays(circuit)
+    return gate_arrays_to_graph(wire_offsets, wires, num_qubits=circuit.num_qubits)
+
+
+def gate_arrays_to_qubit_graph(
+    wire_offsets: np.ndarray, wires: np.ndarray, num_qubits: int, lookahead: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Build the weighted qubit interaction graph from the CSR gate arrays.
+    Every two-qubit gate adds one to the weight of the edge between its qubits.
+    lookahead: only count the gates within the first `lookahead` ASAP layers of the circuit.
+    """
+    qubit_offsets, qubits = _qubit_arrays(wire_offsets, wires, num_qubits)
+    num_gates = len(qubit_offsets) - 1
+    two_qubit_gates = np.flatnonzero(np.diff(qubit_offsets) == 2)
+    if lookahead is not None:
+        layers = np.zeros(num_gates, dtype=np.int64)
+        qubit_depth = np.zeros(num_qubits, dtype=np.int64)
+        for gate_idx in range(num_gates):
+            gate_qubits = qubits[qubit_offsets[gate_idx] : qubit_offsets[gate_idx + 1]]
+            if len(gate_qubits) > 0:
+                layers[gate_idx] = qubit_depth[gate_qubits].max()
+                qubit_depth[gate_qubits] = layers[gate_idx] + 1
+        two_qubit_gates = two_qubit_gates[layers[two_qubit_gates] < lookahead]
+    pairs = np.sort(
+        np.stack(
+            [qubits[qubit_offsets[two_qubit_gates]], qubits[qubit_offsets[two_qubit_gates] + 1]],
+            axis=1,
+        ),
+        axis=1,
+    )
+    edges, edge_weights = np.unique(pairs.reshape(-1, 2), axis=0, return_counts=True)
+    return edges, edge_weights
+
+
+def circuit_to_qubit_graph(
+    circuit: qiskit.QuantumCircuit, lookahead: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Weighted qubit interaction graph of the circuit, see gate_arrays_to_qubit_graph"""
+    wire_offsets, wires = circuit_to_gate_arrays(circuit)
+    return gate_arrays_to_qubit_graph(
+        wire_offsets, wires, num_qubits=circuit.num_qubits, lookahead=lookahead
+    )
+
+
+def _qubit_arrays(
+    wire_offsets: np.ndarray, wires: np.ndarray, num_qubits: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Drop the clbit wires from the CSR gate arrays"""
+    is_qubit = wires < num_qubits
+    cumulative_qubits = np.concatenate([[0], np.cumsum(is_qubit, dtype=np.int64)])
+    return cumulative_qubits[wire_offsets], wires[is_qubit]
 
 
 def write_source_graph_file(graph, save_dir):
@@ -87,7 +168,7 @@ def write_target_graph_file(graph, save_dir):
             "%s/target.txt" % save_dir,
         ]
     )
-    subprocess.call(["rm", "%s/source.txt" % save_dir])
+    os.remove("%s/source.txt" % save_dir)
 
 
 def edges_to_coupling_map(edges):
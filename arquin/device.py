@@ -1,11 +1,10 @@
 from __future__ import annotations
 
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple, Union
 
 import networkx as nx
 import numpy as np
 import qiskit
-import matplotlib.pyplot as plt
 
 import arquin
 
@@ -32,7 +31,14 @@ class Device(FrozenClass):
     dv_2_dp_mapping: device virtual to device physical mapping
     """
 
-    def __init__(self, global_edges: List[List[List[int]]], module_graphs: List[nx.Graph]) -> None:
+    def __init__(
+        self,
+        global_edges: List[List[List[int]]],
+        module_graphs: List[nx.Graph],
+        module_options: Optional[Union[Dict, List[Dict]]] = None,
+        gate_durations: Optional[Dict[str, float]] = None,
+        global_edge_slowdowns: Optional[List[float]] = None,
+    ) -> None:
         """Construct a new Device object
 
         Input
@@ -43,14 +49,27 @@ class Device(FrozenClass):
             are the indices of the two modules and `j` and `l` are the local physical qubit indices
             with respect to each module.
         module_graphs: list of graphs of each module
+        module_options: keyword arguments of arquin.Module applied to every module,
+            e.g. {"num_trials": 8, "seed": 0, "objective": "swaps"},
+            or a list with the keyword arguments of each module, for heterogeneous modules
+        gate_durations: durations by gate name, updating arquin.schedule.GATE_DURATIONS,
+            also used by the modules for the "latency" objective
+        global_edge_slowdowns: slowdown of two-qubit gates over each of the global edges,
+            defaults to arquin.schedule.GLOBAL_EDGE_SLOWDOWN
         """
 
         self.coarse_graph = self._build_coarse_device_graph(global_edges)
         assert len(module_graphs) == self.coarse_graph.number_of_nodes()
-        self.modules, self.dp_2_mp_mapping = self._build_modules(module_graphs)
+        self.gate_durations = dict(arquin.schedule.GATE_DURATIONS)
+        if gate_durations is not None:
+            self.gate_durations.update(gate_durations)
+        self.modules, self.dp_2_mp_mapping = self._build_modules(module_graphs, module_options)
         self.mp_2_dp_mapping = arquin.converters.reverse_dict(self.dp_2_mp_mapping)
         self.fine_graph = self._build_fine_device_graph(global_edges)
         self.size = sum([module.size for module in self.modules])
+        self.global_edge_slowdowns = self._build_global_edge_slowdowns(
+            global_edges, global_edge_slowdowns
+        )
         self.dv_2_mv_mapping = None
         self.mv_2_dv_mapping = None
         self.virtual_circuit = None
@@ -64,13 +83,22 @@ class Device(FrozenClass):
         device_graph.add_edges_from(intermodule_edges)
         return device_graph
 
-    def _build_modules(self, module_graphs: List[nx.Graph]) -> tuple:
+    def _build_modules(
+        self, module_graphs: List[nx.Graph], module_options: Optional[Union[Dict, List[Dict]]]
+    ) -> tuple:
         """Construct arquin.Module objects for each of the provided module graphs."""
+        if module_options is None:
+            module_options = {}
+        if isinstance(module_options, dict):
+            module_options = [module_options] * len(module_graphs)
+        assert len(module_options) == len(module_graphs)
         modules = []
         dp_2_mp_mapping = {}
         device_physical_qubit = 0
-        for module_index, module_graph in enumerate(module_graphs):
-            module = arquin.Module(graph=module_graph, index=module_index)
+        for module_index, (module_graph, options) in enumerate(zip(module_graphs, module_options)):
+            # The modules rank latency trials with the device durations unless given their own
+            options = {"gate_durations": self.gate_durations, **options}
+            module = arquin.Module(graph=module_graph, index=module_index, **options)
             modules.append(module)
             for module_physical_qubit in range(module.size):
                 dp_2_mp_mapping[device_physical_qubit] = (module_index, module_physical_qubit)
@@ -98,7 +126,25 @@ class Device(FrozenClass):
 
         return graph
 
+    def _build_global_edge_slowdowns(
+        self,
+        global_edges: List[List[List[int]]],
+        global_edge_slowdowns: Optional[List[float]],
+    ) -> Dict[Tuple[int, int], float]:
+        """Slowdowns of the global edges keyed by sorted pairs of device physical qubits"""
+        if global_edge_slowdowns is None:
+            global_edge_slowdowns = [arquin.schedule.GLOBAL_EDGE_SLOWDOWN] * len(global_edges)
+        assert len(global_edge_slowdowns) == len(global_edges)
+        slowdowns = {}
+        for (v1, v2), slowdown in zip(global_edges, global_edge_slowdowns):
+            edge = sorted([self.mp_2_dp_mapping[tuple(v1)], self.mp_2_dp_mapping[tuple(v2)]])
+            slowdowns[tuple(edge)] = slowdown
+        return slowdowns
+
     def plot(self, save_dir):
+        # Imported here so that compiling never pays for matplotlib
+        import matplotlib.pyplot as plt
+
         nx.draw(self.fine_graph, with_labels=True)
         plt.savefig("%s/fine_device.pdf" % (save_dir))
         plt.close()
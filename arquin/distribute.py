@@ -3,7 +3,7 @@ from __future__ import annotations
 import subprocess
 import numpy as np
 import qiskit
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 import arquin
 
 
@@ -13,7 +13,7 @@ def distribute_gates(data_dir: str) -> None:
             "/home/weit/scotch/build/bin/gmap",
             "%s/source.txt" % data_dir,
             "%s/target.txt" % data_dir,
-            "%s/distribution.txt" % data_dir
+            "%s/distribution.txt" % data_dir,
         ]
     )
 
@@ -31,22 +31,385 @@ def read_distribution_file(data_dir: str) -> np.ndarray:
     return distribution
 
 
+def partition_graph(
+    edges: np.ndarray,
+    edge_weights: np.ndarray,
+    vertex_weights: np.ndarray,
+    capacities: np.ndarray,
+    max_passes: int = 10,
+) -> np.ndarray:
+    """
+    Partition a weighted graph into len(capacities) parts, minimizing the weight of the cut edges.
+    The total vertex weight of every part never exceeds its capacity.
+    1. Greedy growing: vertices in BFS order join the part they are most connected to,
+       best-fit on ties so that parts are filled one after another
+    2. Refinement: single vertex moves and pairwise swaps with positive gain
+    Distances between the parts are not taken into account.
+    """
+    num_vertices = len(vertex_weights)
+    num_parts = len(capacities)
+    if vertex_weights.sum() > capacities.sum():
+        raise ValueError(
+            "Total vertex weight %d exceeds the total capacity %d"
+            % (vertex_weights.sum(), capacities.sum())
+        )
+    neighbor_offsets, neighbors, neighbor_weights = _graph_to_csr(edges, edge_weights, num_vertices)
+    partition = np.full(num_vertices, -1, dtype=int)
+    loads = np.zeros(num_parts, dtype=vertex_weights.dtype)
+    for vertex in _bfs_order(neighbor_offsets, neighbors, neighbor_weights):
+        vertex_neighbors = slice(neighbor_offsets[vertex], neighbor_offsets[vertex + 1])
+        neighbor_parts = partition[neighbors[vertex_neighbors]]
+        assigned = neighbor_parts >= 0
+        part_affinity = np.bincount(
+            neighbor_parts[assigned],
+            weights=neighbor_weights[vertex_neighbors][assigned],
+            minlength=num_parts,
+        )
+        room = capacities - loads - vertex_weights[vertex]
+        fits = room >= 0
+        # Most connected part first, then the fullest part that still fits
+        score = np.where(fits, part_affinity * (capacities.sum() + 1) - room, -np.inf)
+        part = int(np.argmax(score))
+        partition[vertex] = part
+        loads[part] += vertex_weights[vertex]
+
+    affinity = np.zeros((num_vertices, num_parts))
+    sources = np.repeat(np.arange(num_vertices), np.diff(neighbor_offsets))
+    np.add.at(affinity, (sources, partition[neighbors]), neighbor_weights)
+    for _ in range(max_passes):
+        improved = _refine_moves(
+            partition,
+            affinity,
+            loads,
+            vertex_weights,
+            capacities,
+            neighbor_offsets,
+            neighbors,
+            neighbor_weights,
+        )
+        improved |= _refine_swaps(
+            partition,
+            affinity,
+            loads,
+            vertex_weights,
+            neighbor_offsets,
+            neighbors,
+            neighbor_weights,
+        )
+        if not improved:
+            break
+    return partition
+
+
+def partition_gate_arrays(
+    wire_offsets: np.ndarray,
+    wires: np.ndarray,
+    num_qubits: int,
+    module_sizes: np.ndarray,
+    lookahead: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Partition the gates of a circuit in place of SCOTCH gmap, with the CSR gate arrays of
+    arquin.converters. The qubit interaction graph is partitioned with partition_graph, every
+    module taking at most its size in qubits, and every gate goes to the module of its first qubit.
+    Partitioning the gate dependency graph itself balances gates, not qubits, and cuts the circuit
+    into time slices that need a global communication for every qubit.
+    Returns the module of every qubit and of every gate.
+    """
+    edges, edge_weights = arquin.converters.gate_arrays_to_qubit_graph(
+        wire_offsets, wires, num_qubits=num_qubits, lookahead=lookahead
+    )
+    qubit_partition = partition_graph(
+        edges=edges,
+        edge_weights=edge_weights,
+        vertex_weights=np.ones(num_qubits, dtype=int),
+        capacities=np.asarray(module_sizes),
+    )
+    first_wires = np.append(wires, -1)[wire_offsets[:-1]]
+    has_qubit = (np.diff(wire_offsets) > 0) & (first_wires < num_qubits)
+    gate_distribution = np.zeros(len(wire_offsets) - 1, dtype=int)
+    gate_distribution[has_qubit] = qubit_partition[first_wires[has_qubit]]
+    return qubit_partition, gate_distribution
+
+
+def _graph_to_csr(
+    edges: np.ndarray, edge_weights: np.ndarray, num_vertices: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Symmetric adjacency of the graph in CSR format"""
+    edges = np.asarray(edges, dtype=int).reshape(-1, 2)
+    sources = np.concatenate([edges[:, 0], edges[:, 1]])
+    targets = np.concatenate([edges[:, 1], edges[:, 0]])
+    weights = np.concatenate([edge_weights, edge_weights]).astype(float)
+    order = np.argsort(sources, kind="stable")
+    neighbor_offsets = np.zeros(num_vertices + 1, dtype=int)
+    neighbor_offsets[1:] = np.cumsum(np.bincount(sources, minlength=num_vertices))
+    return neighbor_offsets, targets[order], weights[order]
+
+
+def _bfs_order(
+    neighbor_offsets: np.ndarray, neighbors: np.ndarray, neighbor_weights: np.ndarray
+) -> List[int]:
+    """Breadth first order of the vertices, each component starting from its heaviest vertex"""
+    num_vertices = len(neighbor_offsets) - 1
+    degrees = np.zeros(num_vertices)
+    sources = np.repeat(np.arange(num_vertices), np.diff(neighbor_offsets))
+    np.add.at(degrees, sources, neighbor_weights)
+    visited = np.zeros(num_vertices, dtype=bool)
+    order = []
+    for root in np.argsort(-degrees, kind="stable"):
+        if visited[root]:
+            continue
+        visited[root] = True
+        queue = [root]
+        while queue:
+            order.extend(queue)
+            next_queue: List[int] = []
+            for vertex in queue:
+                vertex_neighbors = neighbors[
+                    neighbor_offsets[vertex] : neighbor_offsets[vertex + 1]
+                ]
+                new_neighbors = np.unique(vertex_neighbors[~visited[vertex_neighbors]])
+                visited[new_neighbors] = True
+                next_queue.extend(new_neighbors)
+            queue = next_queue
+    return order
+
+
+def _move_vertex(
+    vertex: int,
+    part: int,
+    partition: np.ndarray,
+    affinity: np.ndarray,
+    loads: np.ndarray,
+    vertex_weights: np.ndarray,
+    neighbor_offsets: np.ndarray,
+    neighbors: np.ndarray,
+    neighbor_weights: np.ndarray,
+) -> None:
+    vertex_neighbors = slice(neighbor_offsets[vertex], neighbor_offsets[vertex + 1])
+    np.subtract.at(
+        affinity[:, partition[vertex]],
+        neighbors[vertex_neighbors],
+        neighbor_weights[vertex_neighbors],
+    )
+    np.add.at(affinity[:, part], neighbors[vertex_neighbors], neighbor_weights[vertex_neighbors])
+    loads[partition[vertex]] -= vertex_weights[vertex]
+    loads[part] += vertex_weights[vertex]
+    partition[vertex] = part
+
+
+def _refine_moves(
+    partition: np.ndarray,
+    affinity: np.ndarray,
+    loads: np.ndarray,
+    vertex_weights: np.ndarray,
+    capacities: np.ndarray,
+    neighbor_offsets: np.ndarray,
+    neighbors: np.ndarray,
+    neighbor_weights: np.ndarray,
+) -> bool:
+    """Move single vertices to the part they are most connected to, if it has room"""
+    vertex_range = np.arange(len(partition))
+    gains = affinity.max(axis=1) - affinity[vertex_range, partition]
+    improved = False
+    for vertex in np.flatnonzero(gains > 0)[np.argsort(-gains[gains > 0], kind="stable")]:
+        room = capacities - loads - vertex_weights[vertex]
+        gain = np.where(room >= 0, affinity[vertex] - affinity[vertex, partition[vertex]], 0)
+        part = int(np.argmax(gain))
+        if gain[part] > 0:
+            _move_vertex(
+                vertex,
+                part,
+                partition,
+                affinity,
+                loads,
+                vertex_weights,
+                neighbor_offsets,
+                neighbors,
+                neighbor_weights,
+            )
+            improved = True
+    return improved
+
+
+def _refine_swaps(
+    partition: np.ndarray,
+    affinity: np.ndarray,
+    loads: np.ndarray,
+    vertex_weights: np.ndarray,
+    neighbor_offsets: np.ndarray,
+    neighbors: np.ndarray,
+    neighbor_weights: np.ndarray,
+) -> bool:
+    """Swap pairs of vertices with equal weights between two parts"""
+    vertex_range = np.arange(len(partition))
+    internal = affinity[vertex_range, partition]
+    improved = False
+    for vertex in np.flatnonzero(affinity.max(axis=1) > internal).tolist():
+        part = partition[vertex]
+        target = int(np.argmax(affinity[vertex]))
+        if affinity[vertex, target] <= affinity[vertex, part]:
+            continue
+        candidates = np.flatnonzero(
+            (partition == target) & (vertex_weights == vertex_weights[vertex])
+        )
+        if len(candidates) == 0:
+            continue
+        shared_weights = np.zeros(len(partition))
+        vertex_neighbors = slice(neighbor_offsets[vertex], neighbor_offsets[vertex + 1])
+        np.add.at(shared_weights, neighbors[vertex_neighbors], neighbor_weights[vertex_neighbors])
+        gains = (
+            affinity[vertex, target]
+            - affinity[vertex, part]
+            + affinity[candidates, part]
+            - affinity[candidates, target]
+            - 2 * shared_weights[candidates]
+        )
+        best = int(np.argmax(gains))
+        if gains[best] > 0:
+            other = candidates[best]
+            for moved_vertex, moved_part in ((vertex, target), (other, part)):
+                _move_vertex(
+                    moved_vertex,
+                    moved_part,
+                    partition,
+                    affinity,
+                    loads,
+                    vertex_weights,
+                    neighbor_offsets,
+                    neighbors,
+                    neighbor_weights,
+                )
+            improved = True
+    return improved
+
+
+def distribute_qubits(
+    device: arquin.device.Device, lookahead: Optional[int] = None
+) -> Tuple[Dict, np.ndarray]:
+    """
+    Partition the qubit interaction graph of device.virtual_circuit onto the modules.
+    Module capacities are respected, every device_virtual_qubit is assigned.
+    Gates are distributed to the module of their first qubit.
+    """
+    circuit = device.virtual_circuit
+    wire_offsets, wires = arquin.converters.circuit_to_gate_arrays(circuit)
+    qubit_partition, gate_distribution = partition_gate_arrays(
+        wire_offsets,
+        wires,
+        num_qubits=circuit.num_qubits,
+        module_sizes=np.array([module.size for module in device.modules]),
+        lookahead=lookahead,
+    )
+    qubit_distribution: Dict[int, List[qiskit.circuit.Qubit]] = {
+        module.index: [] for module in device.modules
+    }
+    for device_virtual_qubit, module_idx in zip(circuit.qubits, qubit_partition):
+        qubit_distribution[module_idx].append(device_virtual_qubit)
+    return qubit_distribution, gate_distribution
+
+
 def assign_device_virtual_qubits(
     gate_distribution: np.ndarray, device: arquin.device.Device
-) -> None:
-    dag = qiskit.converters.circuit_to_dag(device.virtual_circuit)
-    topological_op_nodes = list(dag.topological_op_nodes())
-    qubit_distribution = {module.index: [] for module in device.modules}
-    for device_virtual_qubit in dag.qubits:
-        gates_on_qubit = list(dag.nodes_on_wire(device_virtual_qubit, only_ops=True))
-        if len(gates_on_qubit) > 0:
-            first_gate = gates_on_qubit[0]
-            gate_idx = topological_op_nodes.index(first_gate)
+) -> Dict:
+    circuit = device.virtual_circuit
+    qubit_to_idx = {qubit: idx for idx, qubit in enumerate(circuit.qubits)}
+    first_gate = np.full(circuit.num_qubits, -1, dtype=int)
+    for gate_idx, instruction in enumerate(circuit.data):
+        for qubit in instruction.qubits:
+            if first_gate[qubit_to_idx[qubit]] == -1:
+                first_gate[qubit_to_idx[qubit]] = gate_idx
+    qubit_distribution: Dict[int, List[qiskit.circuit.Qubit]] = {
+        module.index: [] for module in device.modules
+    }
+    for device_virtual_qubit, gate_idx in zip(circuit.qubits, first_gate):
+        if gate_idx != -1:
             module_idx = gate_distribution[gate_idx]
             qubit_distribution[module_idx].append(device_virtual_qubit)
     return qubit_distribution
 
 
+def qubit_affinity(
+    gate_distribution: np.ndarray,
+    wire_offsets: np.ndarray,
+    wires: np.ndarray,
+    num_qubits: int,
+    num_modules: int,
+    decay: float = 0.5,
+) -> np.ndarray:
+    """
+    Time-decayed affinity of every qubit to every module, (num_qubits, num_modules).
+    The k-th gate on a qubit adds decay**k to the affinity of the qubit to the module of the gate,
+    decay=0 only counts the first gate, as in assign_device_virtual_qubits.
+    """
+    qubit_offsets, qubits = arquin.converters._qubit_arrays(wire_offsets, wires, num_qubits)
+    gate_indices = np.repeat(np.arange(len(qubit_offsets) - 1), np.diff(qubit_offsets))
+    order = np.argsort(qubits, kind="stable")
+    sorted_qubits = qubits[order]
+    ranks = np.arange(len(order)) - np.searchsorted(sorted_qubits, sorted_qubits)
+    affinity = np.bincount(
+        sorted_qubits * num_modules + gate_distribution[gate_indices[order]],
+        weights=np.power(float(decay), ranks),
+        minlength=num_qubits * num_modules,
+    )
+    return affinity.reshape(num_qubits, num_modules)
+
+
+def balance_device_virtual_qubits(
+    gate_distribution: np.ndarray, device: arquin.device.Device, decay: float = 0.5
+) -> Dict:
+    """
+    Capacity-aware assign_device_virtual_qubits.
+    Every device_virtual_qubit, idle ones included, is assigned to a module, no module gets more
+    than Module.size qubits, and the total qubit_affinity of the assignment is maximized.
+    The qubits keep their most affine module unless that overloads a module, then the assignment
+    is solved over the module capacity slots with scipy.optimize.linear_sum_assignment.
+    """
+    circuit = device.virtual_circuit
+    capacities = np.array([module.size for module in device.modules])
+    if circuit.num_qubits > capacities.sum():
+        raise ValueError(
+            "%d qubits do not fit in modules of total size %d"
+            % (circuit.num_qubits, capacities.sum())
+        )
+    wire_offsets, wires = arquin.converters.circuit_to_gate_arrays(circuit)
+    affinity = qubit_affinity(
+        gate_distribution=gate_distribution,
+        wire_offsets=wire_offsets,
+        wires=wires,
+        num_qubits=circuit.num_qubits,
+        num_modules=len(capacities),
+        decay=decay,
+    )
+    active = affinity.any(axis=1)
+    qubit_modules = affinity.argmax(axis=1)
+    loads = np.bincount(qubit_modules[active], minlength=len(capacities))
+    if (loads <= capacities).all():
+        # Idle qubits go to the modules with the most free slots first
+        free_slots = capacities - loads
+        modules_by_room = np.argsort(-free_slots, kind="stable")
+        slot_modules = np.repeat(modules_by_room, free_slots[modules_by_room])
+        qubit_modules[~active] = slot_modules[: np.count_nonzero(~active)]
+    else:
+        # Only needed on overload, scipy is slow to import
+        from scipy.optimize import linear_sum_assignment
+
+        slot_modules = np.repeat(
+            np.arange(len(capacities)), np.minimum(capacities, circuit.num_qubits)
+        )
+        qubit_indices, slot_indices = linear_sum_assignment(
+            affinity[:, slot_modules], maximize=True
+        )
+        qubit_modules[qubit_indices] = slot_modules[slot_indices]
+
+    qubit_distribution: Dict[int, List[qiskit.circuit.Qubit]] = {
+        module.index: [] for module in device.modules
+    }
+    for device_virtual_qubit, module_idx in zip(circuit.qubits, qubit_modules):
+        qubit_distribution[module_idx].append(device_virtual_qubit)
+    return qubit_distribution
+
+
 def construct_module_virtual_circuits(
     device: arquin.device.Device, gate_distribution: np.ndarray
 ) -> Tuple[qiskit.QuantumCircuit, List]:
@@ -55,11 +418,11 @@ def construct_module_virtual_circuits(
     1. Assign the qubits to each module based on front layer gates
     2. Assign as many gates as possible for each module
     """
-    remaining_dag = qiskit.converters.circuit_to_dag(device.virtual_circuit)
-    topological_op_nodes = list(remaining_dag.topological_op_nodes())
+    circuit = device.virtual_circuit
+    remaining_circuit = circuit.copy_empty_like()
     inactive_qubits = set()
-    for gate, module_idx in zip(topological_op_nodes, gate_distribution):
-        device_virtual_qargs = gate.qargs
+    for gate_idx, (gate, module_idx) in enumerate(zip(circuit.data, gate_distribution)):
+        device_virtual_qargs = gate.qubits
         module_virtual_qargs = [
             device.dv_2_mv_mapping[device_virtual_qubit]
             for device_virtual_qubit in device_virtual_qargs
@@ -78,15 +441,18 @@ def construct_module_virtual_circuits(
             module_virtual_qargs = [
                 module_virtual_qubit[1] for module_virtual_qubit in module_virtual_qargs
             ]
-            module.virtual_circuit.append(gate.op, qargs=module_virtual_qargs)
-            remaining_dag.remove_op_node(gate)
+            module.virtual_circuit.append(gate.operation, qargs=module_virtual_qargs)
         else:
             """
             A qubit becomes inactive whenever any gate involving the qubit fails to add to its module
             """
-            inactive_qubits.update(gate.qargs)
-        if len(inactive_qubits) == remaining_dag.width():
+            inactive_qubits.update(gate.qubits)
+            remaining_circuit.append(gate.operation, gate.qubits, gate.clbits)
+        if len(inactive_qubits) == circuit.num_qubits:
+            for remaining_gate in circuit.data[gate_idx + 1 :]:
+                remaining_circuit.append(
+                    remaining_gate.operation, remaining_gate.qubits, remaining_gate.clbits
+                )
             break
 
-    remaining_circuit = qiskit.converters.dag_to_circuit(remaining_dag)
     return remaining_circuit
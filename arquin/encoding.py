@@ -0,0 +1,201 @@
+"""
+Compact array encoding of circuits and qubit mappings, and their transport in shared memory.
+Worker processes read the arrays zero-copy and only build a qiskit.QuantumCircuit where qiskit
+needs one, instead of unpickling circuits, Layouts and tuple-keyed dicts.
+"""
+
+from __future__ import annotations
+
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import qiskit
+
+import arquin
+
+ALIGNMENT = 64
+
+
+def encode_circuit(circuit: qiskit.QuantumCircuit) -> Dict[str, np.ndarray]:
+    """
+    Encode a circuit as arrays:
+    names: opcode table, opcodes: index into names of every instruction,
+    wire_offsets, wires: CSR wires of arquin.converters.circuit_to_gate_arrays,
+    param_offsets, params: CSR float parameters, num_bits: [num_qubits, num_clbits],
+    global_phase: [global phase].
+    Only barriers and the standard gates of qiskit with numeric parameters can be encoded, other
+    operations, including delays, raise a ValueError.
+    """
+    standard_gates = qiskit.circuit.library.get_standard_gate_name_mapping()
+    names: Dict[str, int] = {}
+    opcodes = np.zeros(len(circuit.data), dtype=np.int32)
+    param_offsets = np.zeros(len(circuit.data) + 1, dtype=np.int64)
+    params: List[float] = []
+    for gate_idx, instruction in enumerate(circuit.data):
+        operation = instruction.operation
+        if not _is_encodable(operation, standard_gates):
+            raise ValueError("Cannot encode non standard operation %s" % operation.name)
+        opcodes[gate_idx] = names.setdefault(operation.name, len(names))
+        for param in operation.params:
+            if not isinstance(param, (int, float)):
+                raise ValueError("Cannot encode parameter %s of %s" % (param, operation.name))
+            params.append(param)
+        param_offsets[gate_idx + 1] = len(params)
+    if not isinstance(circuit.global_phase, (int, float)):
+        raise ValueError("Cannot encode global phase %s" % circuit.global_phase)
+    wire_offsets, wires = arquin.converters.circuit_to_gate_arrays(circuit)
+    return {
+        "names": np.array(list(names), dtype=str),
+        "opcodes": opcodes,
+        "wire_offsets": wire_offsets,
+        "wires": wires,
+        "param_offsets": param_offsets,
+        "params": np.array(params, dtype=np.float64),
+        "num_bits": np.array([circuit.num_qubits, circuit.num_clbits], dtype=np.int64),
+        "global_phase": np.array([float(circuit.global_phase)]),
+    }
+
+
+def decode_circuit(
+    arrays: Dict[str, np.ndarray], like: qiskit.QuantumCircuit = None
+) -> qiskit.QuantumCircuit:
+    """
+    Rebuild the circuit encoded by encode_circuit.
+    like: circuit whose registers are reused, so that the qubits compare equal to its qubits
+    """
+    num_qubits, num_clbits = (int(num_bits) for num_bits in arrays["num_bits"])
+    if like is None:
+        circuit = qiskit.QuantumCircuit(num_qubits, num_clbits)
+    else:
+        circuit = qiskit.QuantumCircuit(*like.qregs, *like.cregs)
+    circuit.global_phase = float(arrays["global_phase"][0])
+    bits = list(circuit.qubits) + list(circuit.clbits)
+    factories = [_operation_factory(str(name)) for name in arrays["names"]]
+    wire_offsets, wires = arrays["wire_offsets"], arrays["wires"]
+    param_offsets, params = arrays["param_offsets"], arrays["params"]
+    for gate_idx, opcode in enumerate(arrays["opcodes"]):
+        gate_wires = wires[wire_offsets[gate_idx] : wire_offsets[gate_idx + 1]]
+        qargs = [bits[wire] for wire in gate_wires if wire < num_qubits]
+        cargs = [bits[wire] for wire in gate_wires if wire >= num_qubits]
+        gate_params = params[param_offsets[gate_idx] : param_offsets[gate_idx + 1]]
+        operation = factories[opcode]([float(param) for param in gate_params], len(qargs))
+        circuit.append(operation, qargs, cargs)
+    return circuit
+
+
+def _is_encodable(operation: qiskit.circuit.Operation, standard_gates: Dict) -> bool:
+    """Whether _operation_factory rebuilds the operation from its name and parameters alone"""
+    if operation.name == "barrier":
+        return True
+    # Delays also carry a time unit
+    if operation.name not in standard_gates or operation.name == "delay":
+        return False
+    if type(operation) is not type(standard_gates[operation.name]):
+        return False
+    num_ctrl_qubits = getattr(operation, "num_ctrl_qubits", 0)
+    return num_ctrl_qubits == 0 or operation.ctrl_state == 2**num_ctrl_qubits - 1
+
+
+def _operation_factory(name: str) -> Callable:
+    """Build operations from their name, parameters and number of qubits"""
+    if name == "barrier":
+        return lambda params, num_qubits: qiskit.circuit.Barrier(num_qubits)
+    standard_gates = qiskit.circuit.library.get_standard_gate_name_mapping()
+    if name not in standard_gates:
+        raise ValueError("Cannot decode non standard operation %s" % name)
+    operation_class = type(standard_gates[name])
+    return lambda params, num_qubits: operation_class(*params)
+
+
+def encode_layout(
+    mapping: Dict[int, qiskit.circuit.Qubit], circuit: qiskit.QuantumCircuit
+) -> np.ndarray:
+    """
+    Encode a physical to virtual mapping, e.g. Module.mp_2_mv_mapping.
+    layout[p] is the index of the virtual qubit in circuit.qubits, -1 for ancillas.
+    """
+    qubit_to_idx = {qubit: idx for idx, qubit in enumerate(circuit.qubits)}
+    layout = np.full(max(mapping, default=-1) + 1, -1, dtype=np.int64)
+    for physical_qubit, virtual_qubit in mapping.items():
+        layout[physical_qubit] = qubit_to_idx.get(virtual_qubit, -1)
+    return layout
+
+
+def decode_layout(
+    layout: np.ndarray, circuit: qiskit.QuantumCircuit
+) -> Dict[int, qiskit.circuit.Qubit]:
+    """Rebuild the mapping encoded by encode_layout, without the ancillas"""
+    return {
+        physical_qubit: circuit.qubits[virtual_qubit]
+        for physical_qubit, virtual_qubit in enumerate(layout)
+        if virtual_qubit >= 0
+    }
+
+
+def encode_device_mapping(
+    dv_2_mv_mapping: Dict, device_qubits: List, module_qubits: List[List]
+) -> np.ndarray:
+    """
+    Encode a device virtual to module virtual mapping, e.g. Device.dv_2_mv_mapping.
+    mapping[dv] = [module index, index of the module virtual qubit in module_qubits[module]],
+    [-1, -1] for unmapped device virtual qubits.
+    """
+    module_qubit_to_idx = [
+        {qubit: idx for idx, qubit in enumerate(qubits)} for qubits in module_qubits
+    ]
+    mapping = np.full((len(device_qubits), 2), -1, dtype=np.int64)
+    for device_virtual_idx, device_virtual_qubit in enumerate(device_qubits):
+        if device_virtual_qubit in dv_2_mv_mapping:
+            module_index, module_virtual_qubit = dv_2_mv_mapping[device_virtual_qubit]
+            mapping[device_virtual_idx] = [
+                module_index,
+                module_qubit_to_idx[module_index][module_virtual_qubit],
+            ]
+    return mapping
+
+
+def decode_device_mapping(
+    mapping: np.ndarray, device_qubits: List, module_qubits: List[List]
+) -> Dict:
+    """Rebuild the mapping encoded by encode_device_mapping"""
+    return {
+        device_qubits[device_virtual_idx]: (
+            int(module_index),
+            module_qubits[module_index][module_virtual_idx],
+        )
+        for device_virtual_idx, (module_index, module_virtual_idx) in enumerate(mapping)
+        if module_index >= 0
+    }
+
+
+def share_arrays(arrays: Dict[str, np.ndarray]) -> Tuple[shared_memory.SharedMemory, Dict]:
+    """
+    Copy the arrays into one shared memory block.
+    Returns the block, to be closed and unlinked by the caller once the workers are done,
+    and a small picklable manifest to hand to attach_arrays in the workers.
+    """
+    layout = {}
+    offset = 0
+    for key, array in arrays.items():
+        layout[key] = (array.dtype.str, array.shape, offset)
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for key, array in arrays.items():
+        _, shape, array_offset = layout[key]
+        np.ndarray(shape, dtype=array.dtype, buffer=block.buf, offset=array_offset)[...] = array
+    return block, {"name": block.name, "arrays": layout}
+
+
+def attach_arrays(manifest: Dict) -> Tuple[shared_memory.SharedMemory, Dict[str, np.ndarray]]:
+    """
+    Read-only views of the arrays of share_arrays, without copying them.
+    The returned block must stay referenced, and be closed, while the views are in use.
+    """
+    block = shared_memory.SharedMemory(name=manifest["name"])
+    arrays = {}
+    for key, (dtype, shape, offset) in manifest["arrays"].items():
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf, offset=offset)
+        array.flags.writeable = False
+        arrays[key] = array
+    return block, arrays
@@ -0,0 +1,181 @@
+"""
+Streaming ingestion of OpenQASM 2 files.
+The file is read statement by statement and the gates are written straight into the compact CSR
+gate arrays of arquin.converters, without building a qiskit.QuantumCircuit or its DAG.
+ModularCompiler does not use it, it still needs the qiskit.QuantumCircuit of the whole program.
+"""
+
+from __future__ import annotations
+
+import array
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import arquin
+
+REGISTER_PATTERN = re.compile(r"^(qreg|creg)\s+(\w+)\s*\[\s*(\d+)\s*\]$")
+ARGUMENT_PATTERN = re.compile(r"^(\w+)\s*(?:\[\s*(\d+)\s*\])?$")
+IGNORED_STATEMENTS = ("OPENQASM", "include")
+DEFINITION_STATEMENTS = ("gate", "opaque")
+CONDITION_PATTERN = re.compile(r"^if\s*\(\s*(\w+)\s*==\s*\d+\s*\)\s*(.+)$", re.DOTALL)
+
+
+def read_statements(file_name: str) -> Iterator[str]:
+    """Yield the statements of a QASM file one at a time, skipping comments and gate bodies"""
+    buffer = ""
+    body_depth = 0
+    with open(file_name, "r") as file:
+        for line in file:
+            line = line.split("//", 1)[0]
+            if body_depth == 0 and "{" not in line:
+                *statements, buffer = (buffer + line).split(";")
+            else:
+                statements, buffer, body_depth = _split_gate_bodies(line, buffer, body_depth)
+            for statement in statements:
+                statement = statement.strip()
+                if statement:
+                    yield statement
+    if buffer.strip():
+        raise ValueError("Unterminated statement %s" % buffer.strip())
+
+
+def _split_gate_bodies(line: str, buffer: str, body_depth: int) -> Tuple[List[str], str, int]:
+    """Split a line with braces into statements, dropping everything inside gate bodies"""
+    statements = []
+    for character in line:
+        if body_depth > 0:
+            body_depth += {"{": 1, "}": -1}.get(character, 0)
+        elif character == "{":
+            body_depth = 1
+            buffer = ""
+        elif character == ";":
+            statements.append(buffer)
+            buffer = ""
+        else:
+            buffer += character
+    return statements, buffer, body_depth
+
+
+def stream_qasm(
+    file_name: str, num_bits: Optional[Dict[str, int]] = None
+) -> Iterator[Tuple[str, List[int], List[int], str]]:
+    """
+    Yield (name, qubits, clbits, params) for every instruction of a QASM file.
+    Qubits and clbits are flat indices over all the registers in declaration order.
+    Register arguments are broadcast as in OpenQASM 2.
+    Instructions conditioned with `if(creg==n)` also get the clbits of creg, as in qiskit.
+    num_bits: optional dict, updated with the number of declared "qreg" and "creg" bits
+    """
+    registers: Dict[str, Tuple[str, int, int]] = {}
+    if num_bits is None:
+        num_bits = {}
+    num_bits.update({"qreg": 0, "creg": 0})
+    for statement in read_statements(file_name):
+        keyword = statement.split(None, 1)[0]
+        if keyword in IGNORED_STATEMENTS or keyword in DEFINITION_STATEMENTS:
+            continue
+        register = REGISTER_PATTERN.match(statement)
+        if register:
+            kind, name, size = register.group(1), register.group(2), int(register.group(3))
+            registers[name] = (kind, num_bits[kind], size)
+            num_bits[kind] += size
+            continue
+        condition_clbits = []
+        condition = CONDITION_PATTERN.match(statement)
+        if condition:
+            condition_clbits = _resolve_argument(condition.group(1), registers)
+            statement = condition.group(2)
+        for name, qubits, clbits, params in _expand_instruction(statement, registers):
+            yield name, qubits, clbits + [
+                clbit for clbit in condition_clbits if clbit not in clbits
+            ], params
+
+
+def _expand_instruction(
+    statement: str, registers: Dict[str, Tuple[str, int, int]]
+) -> Iterator[Tuple[str, List[int], List[int], str]]:
+    """Yield the instructions of one statement, broadcast over register arguments"""
+    name, params, arguments = _split_instruction(statement)
+    if name == "measure":
+        qubit_arguments, clbit_arguments = arguments.split("->")
+        for qubit, clbit in zip(
+            _resolve_argument(qubit_arguments, registers),
+            _resolve_argument(clbit_arguments, registers),
+        ):
+            yield name, [qubit], [clbit], params
+    elif name == "barrier":
+        qubits = [
+            qubit
+            for argument in arguments.split(",")
+            for qubit in _resolve_argument(argument, registers)
+        ]
+        yield name, qubits, [], params
+    else:
+        resolved = [_resolve_argument(argument, registers) for argument in arguments.split(",")]
+        broadcast = max(len(qubits) for qubits in resolved)
+        for counter in range(broadcast):
+            qubits = [qubits[counter % len(qubits)] for qubits in resolved]
+            yield name, qubits, [], params
+
+
+def _split_instruction(statement: str) -> Tuple[str, str, str]:
+    """Split `name(params) arguments` into its three parts"""
+    match = re.match(r"^(\w+)\s*", statement)
+    if match is None:
+        raise ValueError("Cannot parse statement %s" % statement)
+    name, rest = match.group(1), statement[match.end() :]
+    if not rest.startswith("("):
+        return name, "", rest.strip()
+    close = rest.find(")")
+    if close > 0 and "(" not in rest[1:close]:
+        return name, rest[1:close].strip(), rest[close + 1 :].strip()
+    depth = 0
+    for position, character in enumerate(rest):
+        depth += {"(": 1, ")": -1}.get(character, 0)
+        if depth == 0:
+            return name, rest[1:position].strip(), rest[position + 1 :].strip()
+    raise ValueError("Unbalanced parentheses in %s" % statement)
+
+
+def _resolve_argument(argument: str, registers: Dict[str, Tuple[str, int, int]]) -> List[int]:
+    """Flat indices of `reg[i]` or of every bit in `reg`"""
+    match = ARGUMENT_PATTERN.match(argument.strip())
+    if match is None or match.group(1) not in registers:
+        raise ValueError("Unknown argument %s" % argument.strip())
+    _, offset, size = registers[match.group(1)]
+    if match.group(2) is None:
+        return list(range(offset, offset + size))
+    index = int(match.group(2))
+    if index >= size:
+        raise ValueError("Index out of range in %s" % argument.strip())
+    return [offset + index]
+
+
+def qasm_to_gate_arrays(file_name: str) -> Tuple[int, np.ndarray, np.ndarray]:
+    """
+    Stream a QASM file into the CSR gate arrays used by arquin.converters.gate_arrays_to_graph.
+    Clbits are numbered after the qubits, as in arquin.converters.circuit_to_gate_arrays.
+    Only the gate arrays are kept in memory, as typed arrays of 8 bytes per entry.
+    Returns num_qubits, wire_offsets, wires.
+    """
+    wire_offsets = array.array("q", [0])
+    streamed_wires = array.array("q")
+    num_bits: Dict[str, int] = {}
+    for _, qubits, clbits, _ in stream_qasm(file_name, num_bits=num_bits):
+        streamed_wires.extend(qubits)
+        # Registers may be declared anywhere, mark the clbits as negative until the end
+        streamed_wires.extend(-1 - clbit for clbit in clbits)
+        wire_offsets.append(len(streamed_wires))
+    num_qubits = num_bits["qreg"]
+    wires = np.frombuffer(streamed_wires, dtype=np.int64).copy()
+    is_clbit = wires < 0
+    wires[is_clbit] = num_qubits - 1 - wires[is_clbit]
+    return num_qubits, np.frombuffer(wire_offsets, dtype=np.int64), wires
+
+
+def qasm_to_graph(file_name: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Gate dependency graph of a QASM file, same as arquin.converters.circuit_to_graph"""
+    num_qubits, wire_offsets, wires = qasm_to_gate_arrays(file_name)
+    return arquin.converters.gate_arrays_to_graph(wire_offsets, wires, num_qubits=num_qubits)
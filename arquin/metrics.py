@@ -0,0 +1,173 @@
+"""
+Fast estimates of the quality of gate distributions, without running ModularCompiler.run.
+Every metric takes one gate distribution, as returned by arquin.distribute.read_distribution_file,
+or a batch of candidate distributions stacked into a (num_candidates, num_gates) array, and returns
+one value per candidate. The gates are described by the CSR gate arrays of arquin.converters.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+import arquin
+
+
+def cut_size(
+    gate_distributions: np.ndarray, edges: np.ndarray, edge_weights: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Total weight of the gate dependency graph edges between two modules"""
+    distributions, squeeze = _batch(gate_distributions)
+    if edge_weights is None:
+        edge_weights = np.ones(len(edges))
+    edges = np.asarray(edges).reshape(-1, 2)
+    cut = distributions[:, edges[:, 0]] != distributions[:, edges[:, 1]]
+    return _unbatch(cut @ edge_weights, squeeze)
+
+
+def global_comms(
+    gate_distributions: np.ndarray, wire_offsets: np.ndarray, wires: np.ndarray, num_qubits: int
+) -> np.ndarray:
+    """
+    Estimated number of global communications: the number of times a qubit moves to another
+    module, i.e. consecutive gates on a qubit wire that are distributed to different modules
+    """
+    distributions, squeeze = _batch(gate_distributions)
+    sorted_qubits, sorted_gates = _wire_order(wire_offsets, wires, num_qubits)
+    same_qubit = sorted_qubits[1:] == sorted_qubits[:-1]
+    moves = distributions[:, sorted_gates[:-1]] != distributions[:, sorted_gates[1:]]
+    return _unbatch((moves & same_qubit).sum(axis=1), squeeze)
+
+
+def module_loads(
+    gate_distributions: np.ndarray, vertex_weights: np.ndarray, num_modules: int
+) -> np.ndarray:
+    """Summed vertex weights of the gates distributed to every module, (..., num_modules)"""
+    distributions, squeeze = _batch(gate_distributions)
+    num_candidates = len(distributions)
+    bins = distributions + num_modules * np.arange(num_candidates)[:, None]
+    loads = np.bincount(
+        bins.ravel(),
+        weights=np.tile(vertex_weights, num_candidates),
+        minlength=num_candidates * num_modules,
+    ).reshape(num_candidates, num_modules)
+    return _unbatch(loads, squeeze)
+
+
+def load_imbalance(
+    gate_distributions: np.ndarray, vertex_weights: np.ndarray, capacities: np.ndarray
+) -> np.ndarray:
+    """
+    Load of every module relative to its capacity, e.g. Module.size, (..., num_modules).
+    Values above 1 overload the module.
+    """
+    capacities = np.asarray(capacities)
+    return module_loads(gate_distributions, vertex_weights, len(capacities)) / capacities
+
+
+def qubit_modules(
+    gate_distributions: np.ndarray, wire_offsets: np.ndarray, wires: np.ndarray, num_qubits: int
+) -> np.ndarray:
+    """
+    Module of every qubit, as in arquin.distribute.assign_device_virtual_qubits:
+    the module of the first gate on the qubit, -1 for idle qubits. (..., num_qubits)
+    """
+    distributions, squeeze = _batch(gate_distributions)
+    sorted_qubits, sorted_gates = _wire_order(wire_offsets, wires, num_qubits)
+    first_on_qubit = np.ones(len(sorted_qubits), dtype=bool)
+    first_on_qubit[1:] = sorted_qubits[1:] != sorted_qubits[:-1]
+    modules = np.full((len(distributions), num_qubits), -1, dtype=distributions.dtype)
+    modules[:, sorted_qubits[first_on_qubit]] = distributions[:, sorted_gates[first_on_qubit]]
+    return _unbatch(modules, squeeze)
+
+
+def scheduled_gates(
+    gate_distributions: np.ndarray,
+    wire_offsets: np.ndarray,
+    wires: np.ndarray,
+    num_qubits: int,
+    qubit_distributions: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Number of gates arquin.distribute.construct_module_virtual_circuits schedules in the modules.
+    A gate is scheduled when all of its qubits are in its module and none of its qubits was used by
+    an earlier gate that failed. The failures are propagated along the qubit wires to a fixpoint.
+    qubit_distributions: module of every qubit, defaults to qubit_modules
+    """
+    distributions, squeeze = _batch(gate_distributions)
+    if qubit_distributions is None:
+        qubit_distributions = qubit_modules(distributions, wire_offsets, wires, num_qubits)
+    qubit_distributions = np.broadcast_to(qubit_distributions, (len(distributions), num_qubits))
+    qubit_offsets, qubits = arquin.converters._qubit_arrays(wire_offsets, wires, num_qubits)
+    num_gates = len(qubit_offsets) - 1
+    gate_indices = np.repeat(np.arange(num_gates), np.diff(qubit_offsets))
+    misplaced = qubit_distributions[:, qubits] != distributions[:, gate_indices]
+    failed = _any_per_gate(misplaced, qubit_offsets)
+
+    order = np.argsort(qubits, kind="stable")
+    sorted_qubits = qubits[order]
+    sorted_gates = gate_indices[order]
+    first_on_qubit = np.ones(len(sorted_qubits), dtype=bool)
+    first_on_qubit[1:] = sorted_qubits[1:] != sorted_qubits[:-1]
+    segment_starts = np.maximum.accumulate(np.where(first_on_qubit, np.arange(len(order)), 0))
+    inverse_order = np.empty_like(order)
+    inverse_order[order] = np.arange(len(order))
+    while True:
+        # A qubit is inactive from its first failed gate on
+        failed_on_wire = np.cumsum(failed[:, sorted_gates], axis=1)
+        failed_before_segment = np.concatenate(
+            [np.zeros((len(failed), 1), dtype=failed_on_wire.dtype), failed_on_wire], axis=1
+        )[:, segment_starts]
+        inactive = failed_on_wire > failed_before_segment
+        next_failed = failed | _any_per_gate(inactive[:, inverse_order], qubit_offsets)
+        if np.array_equal(next_failed, failed):
+            break
+        failed = next_failed
+    return _unbatch(num_gates - failed.sum(axis=1), squeeze)
+
+
+def partition_metrics(
+    gate_distributions: np.ndarray,
+    wire_offsets: np.ndarray,
+    wires: np.ndarray,
+    num_qubits: int,
+    capacities: np.ndarray,
+) -> Dict[str, np.ndarray]:
+    """All the metrics of the gate distributions, keyed by metric name"""
+    vertex_weights, edges = arquin.converters.gate_arrays_to_graph(
+        wire_offsets, wires, num_qubits=num_qubits
+    )
+    return {
+        "cut_size": cut_size(gate_distributions, edges),
+        "global_comms": global_comms(gate_distributions, wire_offsets, wires, num_qubits),
+        "load_imbalance": load_imbalance(gate_distributions, vertex_weights, capacities),
+        "scheduled_gates": scheduled_gates(gate_distributions, wire_offsets, wires, num_qubits),
+    }
+
+
+def _batch(gate_distributions: np.ndarray) -> Tuple[np.ndarray, bool]:
+    distributions = np.asarray(gate_distributions)
+    return np.atleast_2d(distributions), distributions.ndim == 1
+
+
+def _unbatch(values: np.ndarray, squeeze: bool) -> np.ndarray:
+    return values[0] if squeeze else values
+
+
+def _wire_order(
+    wire_offsets: np.ndarray, wires: np.ndarray, num_qubits: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Qubit and gate of every qubit wire entry, sorted by qubit and then in circuit order"""
+    qubit_offsets, qubits = arquin.converters._qubit_arrays(wire_offsets, wires, num_qubits)
+    gate_indices = np.repeat(np.arange(len(qubit_offsets) - 1), np.diff(qubit_offsets))
+    order = np.argsort(qubits, kind="stable")
+    return qubits[order], gate_indices[order]
+
+
+def _any_per_gate(entries: np.ndarray, qubit_offsets: np.ndarray) -> np.ndarray:
+    """Reduce per qubit entry flags in circuit order to one flag per gate"""
+    counts = np.concatenate(
+        [np.zeros((len(entries), 1), dtype=np.int64), np.cumsum(entries, axis=1)], axis=1
+    )
+    return counts[:, qubit_offsets[1:]] > counts[:, qubit_offsets[:-1]]
@@ -1,10 +1,14 @@
 from __future__ import annotations
 
 import copy
+import glob
+import io
 import os
-import subprocess
-from typing import Dict, List
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
 import qiskit
 
 import arquin
@@ -17,49 +21,108 @@ class ModularCompiler:
         circuit_name: str,
         device: arquin.device.Device,
         device_name: str,
+        partition_mode: str = "gate",
+        lookahead: Optional[int] = None,
+        seam_window: int = 0,
+        partitioner: arquin.partitioner.PartitionerService = None,
+        checkpoint_interval: Optional[float] = None,
+        data_dir: Optional[str] = None,
+        in_memory: bool = False,
+        balance_qubits: bool = True,
+        affinity_decay: float = 0.5,
+        report_schedule: bool = False,
+        figure_dir: Optional[str] = None,
     ) -> None:
+        """
+        partition_mode: "gate" partitions the gate dependency graph with SCOTCH.
+            "qubit" partitions the qubit interaction graph, module capacities are a hard constraint.
+        lookahead: number of ASAP layers counted in the qubit interaction graph, None for all.
+            Also used by the in process gate partitioning, see in_memory.
+        seam_window: number of gates per qubit on each side of a recursion seam that are optimized
+            across the seam when combining, 0 to disable
+        partitioner: running PartitionerService of the device used in the "gate" partition_mode,
+            instead of calling SCOTCH on files in data_dir
+        checkpoint_interval: minimum number of seconds between two checkpoints of the compilation
+            state in data_dir, taken at the end of a recursion. 0 for every recursion,
+            None to disable.
+        data_dir: working directory of the run, created if needed and never cleared. Defaults to a
+            new unique directory under ./data/<device_name>/<circuit_name>, so that concurrent runs
+            never share files. Pass the directory of a previous run to resume it.
+        in_memory: do not use any files, gates are partitioned in process with
+            arquin.distribute.partition_gate_arrays unless a partitioner is given
+        balance_qubits: in the "gate" partition_mode, assign the qubits to modules within the
+            module capacities with arquin.distribute.balance_device_virtual_qubits, instead of to
+            the module of their first gate
+        affinity_decay: weight decay of later gates on a qubit in the balanced assignment
+        report_schedule: print arquin.schedule.schedule_report of the device physical circuit after
+            every recursion. It schedules the whole circuit so far, which gets slow on long runs.
+        figure_dir: directory of the figures of run(visualize=True). Defaults to data_dir, or to a
+            new unique temporary directory in_memory, created on the first figure.
+        """
+        if in_memory and checkpoint_interval is not None:
+            raise ValueError("Checkpoints need files, they cannot be used in_memory")
+        if partition_mode not in ("gate", "qubit"):
+            raise ValueError("Unknown partition_mode %s" % partition_mode)
+        self.partition_mode = partition_mode
+        self.lookahead = lookahead
+        self.seam_window = seam_window
+        self.partitioner = partitioner
+        self.checkpoint_interval = checkpoint_interval
+        self.balance_qubits = balance_qubits
+        self.affinity_decay = affinity_decay
+        self.report_schedule = report_schedule
+        self.figure_dir = figure_dir
         self.virtual_circuit = circuit
         self.circuit_name = circuit_name
         self.device = device
         self.device_name = device_name
-        self.data_dir = "./data/%s/%s" % (self.device_name, self.circuit_name)
-        if os.path.exists(self.data_dir):
-            subprocess.run(["rm", "-rf", self.data_dir])
-        os.makedirs(self.data_dir)
-
-    def run(self, visualize: bool) -> None:
-        print("Step 0: convert the device topology graph to SCOTCH format")
-        device_graph = arquin.converters.edges_to_source_graph(
-            edges=self.device.coarse_graph.edges, vertex_weights=None
-        )
-        arquin.converters.write_target_graph_file(graph=device_graph, save_dir=self.data_dir)
+        self.data_dir: Optional[str]
+        if in_memory:
+            self.data_dir = None
+        elif data_dir is None:
+            parent_dir = "./data/%s/%s" % (self.device_name, self.circuit_name)
+            os.makedirs(parent_dir, exist_ok=True)
+            self.data_dir = tempfile.mkdtemp(prefix="run_", dir=parent_dir)
+        else:
+            self.data_dir = data_dir
+            os.makedirs(self.data_dir, exist_ok=True)
+
+    def run(self, visualize: bool, resume: bool = False) -> None:
+        """
+        visualize: save a summary figure of every recursion to figure_dir
+        resume: continue from the latest checkpoint in data_dir instead of starting over.
+            The compiler must be constructed with the same circuit and a fresh device.
+        """
+        if resume and self.data_dir is None:
+            raise ValueError("Cannot resume an in_memory run")
+        if resume:
+            recursion_counter = self.load_checkpoint()
+        else:
+            self.device.virtual_circuit = self.virtual_circuit
+            recursion_counter = 0
+        last_checkpoint_time = time.perf_counter()
+
+        if self.partition_mode == "gate" and self.partitioner is None and self.data_dir is not None:
+            print("Step 0: convert the device topology graph to SCOTCH format")
+            device_graph = arquin.converters.edges_to_source_graph(
+                edges=self.device.coarse_graph.edges, vertex_weights=None
+            )
+            arquin.converters.write_target_graph_file(graph=device_graph, save_dir=self.data_dir)
 
-        self.device.virtual_circuit = self.virtual_circuit
-        recursion_counter = 0
         while self.device.virtual_circuit.size() > 0:
             print("*" * 20, "Recursion %d" % recursion_counter, "*" * 20)
             print("Remaining virtual_circuit size %d" % self.device.virtual_circuit.size())
 
             print("Step 1: Distribute the virtual gates in remaining virtual_circuit to modules")
-            vertex_weights, edges = arquin.converters.circuit_to_graph(
-                circuit=self.device.virtual_circuit
-            )
-            circuit_graph = arquin.converters.edges_to_source_graph(
-                edges=edges, vertex_weights=vertex_weights
-            )
-            arquin.converters.write_source_graph_file(graph=circuit_graph, save_dir=self.data_dir)
-            arquin.distribute.distribute_gates(data_dir=self.data_dir)
-            gate_distribution = arquin.distribute.read_distribution_file(data_dir=self.data_dir)
+            qubit_distribution, gate_distribution = self.distribute()
             print(gate_distribution)
-            assert len(circuit_graph)-3 == self.device.virtual_circuit.size()
+            if visualize:
+                self.plot_recursion(recursion_counter, gate_distribution)
             print("-" * 10)
 
             print("Step 2: Assign the device_virtual_qubit to modules")
-            # TODO: debug #qubits exceed module capacity
-            qubit_distribution = arquin.distribute.assign_device_virtual_qubits(
-                gate_distribution=gate_distribution,
-                device=self.device,
-            )
+            if qubit_distribution is None:
+                qubit_distribution = self.assign_qubits(gate_distribution)
             for module_index in qubit_distribution:
                 print("Module {:d} : {}".format(module_index, qubit_distribution[module_index]))
                 self.device.modules[module_index].virtual_circuit = qiskit.QuantumCircuit(len(qubit_distribution[module_index]))
@@ -84,6 +147,148 @@ class ModularCompiler:
             print("-" * 10)
             self.device.virtual_circuit = next_virtual_circuit
             recursion_counter += 1
+            if (
+                self.checkpoint_interval is not None
+                and time.perf_counter() - last_checkpoint_time >= self.checkpoint_interval
+            ):
+                checkpoint_begin = time.perf_counter()
+                self.save_checkpoint(recursion_counter)
+                last_checkpoint_time = time.perf_counter()
+                print("Checkpoint took {:.3f} s".format(last_checkpoint_time - checkpoint_begin))
+
+    def save_checkpoint(self, recursion_counter: int) -> None:
+        """
+        Save the state at the start of recursion_counter to a binary .npz file in data_dir:
+        the remaining virtual circuit and the combined physical circuit in QPY, which handles any
+        operation and symbolic parameters, and all the mappings as arrays.
+        Only the latest checkpoint is kept.
+        """
+        circuits = io.BytesIO()
+        qiskit.qpy.dump([self.device.virtual_circuit, self.device.physical_circuit], circuits)
+        # Values typed Any, the numpy stubs would match them against the options of np.savez
+        arrays: Dict[str, Any] = {
+            "recursion_counter": np.array([recursion_counter]),
+            "circuits": np.frombuffer(circuits.getvalue(), dtype=np.uint8),
+        }
+        module_qubits = [module.virtual_circuit.qubits for module in self.device.modules]
+        arrays["module_num_qubits"] = np.array([len(qubits) for qubits in module_qubits])
+        arrays["dv_2_mv_mapping"] = arquin.encoding.encode_device_mapping(
+            self.device.dv_2_mv_mapping, self.virtual_circuit.qubits, module_qubits
+        )
+        for module in self.device.modules:
+            arrays["mp_2_mv_mapping_%d" % module.index] = arquin.encoding.encode_layout(
+                module.mp_2_mv_mapping, module.virtual_circuit
+            )
+        file_name = "%s/checkpoint_%06d.npz" % (self.data_dir, recursion_counter)
+        with open(file_name + ".tmp", "wb") as file:
+            np.savez(file, **arrays)
+        # Atomic, a crash while writing never leaves a broken latest checkpoint behind
+        os.replace(file_name + ".tmp", file_name)
+        for old_file_name in glob.glob("%s/checkpoint_*.npz" % self.data_dir):
+            if old_file_name != file_name:
+                os.remove(old_file_name)
+
+    def load_checkpoint(self) -> int:
+        """Restore the state of the latest checkpoint, returns the recursion to continue from"""
+        file_names = sorted(glob.glob("%s/checkpoint_*.npz" % self.data_dir))
+        if len(file_names) == 0:
+            raise FileNotFoundError("No checkpoint in %s" % self.data_dir)
+        with np.load(file_names[-1]) as checkpoint:
+            arrays = dict(checkpoint)
+        print("Resume from %s" % file_names[-1])
+        self.device.virtual_circuit, self.device.physical_circuit = qiskit.qpy.load(
+            io.BytesIO(arrays["circuits"].tobytes())
+        )
+
+        module_qubits = []
+        for module, num_qubits in zip(self.device.modules, arrays["module_num_qubits"]):
+            module.virtual_circuit = qiskit.QuantumCircuit(int(num_qubits))
+            module_qubits.append(module.virtual_circuit.qubits)
+        self.device.dv_2_mv_mapping = arquin.encoding.decode_device_mapping(
+            arrays["dv_2_mv_mapping"], self.virtual_circuit.qubits, module_qubits
+        )
+        self.device.mv_2_dv_mapping = arquin.converters.reverse_dict(self.device.dv_2_mv_mapping)
+        for module in self.device.modules:
+            module.mv_2_dv_mapping = {
+                module_virtual_qubit: device_virtual_qubit
+                for (module_index, module_virtual_qubit), device_virtual_qubit in (
+                    self.device.mv_2_dv_mapping.items()
+                )
+                if module_index == module.index
+            }
+            module.mp_2_mv_mapping = arquin.encoding.decode_layout(
+                arrays["mp_2_mv_mapping_%d" % module.index], module.virtual_circuit
+            )
+        return int(arrays["recursion_counter"][0])
+
+    def distribute(self) -> Tuple[Optional[Dict], np.ndarray]:
+        """
+        Step 1 in the partition_mode, returns qubit_distribution and gate_distribution.
+        qubit_distribution is None in the "gate" partition_mode, the qubits are assigned in step 2.
+        """
+        if self.partition_mode == "qubit":
+            return arquin.distribute.distribute_qubits(device=self.device, lookahead=self.lookahead)
+        return None, self.distribute_gates()
+
+    def assign_qubits(self, gate_distribution: np.ndarray) -> Dict:
+        """Step 2 in the "gate" partition_mode, returns qubit_distribution"""
+        if self.balance_qubits:
+            return arquin.distribute.balance_device_virtual_qubits(
+                gate_distribution=gate_distribution,
+                device=self.device,
+                decay=self.affinity_decay,
+            )
+        return arquin.distribute.assign_device_virtual_qubits(
+            gate_distribution=gate_distribution,
+            device=self.device,
+        )
+
+    def plot_recursion(self, recursion_counter: int, gate_distribution: np.ndarray) -> None:
+        """Save the summary figure of a recursion to figure_dir"""
+        if self.figure_dir is None and self.data_dir is not None:
+            self.figure_dir = self.data_dir
+        elif self.figure_dir is None:
+            self.figure_dir = tempfile.mkdtemp(prefix="arquin_figures_")
+            print("Saving the figures to %s" % self.figure_dir)
+        os.makedirs(self.figure_dir, exist_ok=True)
+        arquin.visualize.plot_recursion(
+            recursion_counter=recursion_counter,
+            device=self.device,
+            virtual_circuit=self.device.virtual_circuit,
+            gate_distribution=gate_distribution,
+            save_dir=self.figure_dir,
+        )
+
+    def distribute_gates(self) -> np.ndarray:
+        circuit = self.device.virtual_circuit
+        wire_offsets, wires = arquin.converters.circuit_to_gate_arrays(circuit)
+        if self.partitioner is not None:
+            return self.partitioner.partition(
+                wire_offsets=wire_offsets,
+                wires=wires,
+                num_qubits=circuit.num_qubits,
+                lookahead=self.lookahead,
+            )
+        if self.data_dir is None:
+            _, gate_distribution = arquin.distribute.partition_gate_arrays(
+                wire_offsets,
+                wires,
+                num_qubits=circuit.num_qubits,
+                module_sizes=np.array([module.size for module in self.device.modules]),
+                lookahead=self.lookahead,
+            )
+            return gate_distribution
+        vertex_weights, edges = arquin.converters.gate_arrays_to_graph(
+            wire_offsets, wires, num_qubits=circuit.num_qubits
+        )
+        circuit_graph = arquin.converters.edges_to_source_graph(
+            edges=edges, vertex_weights=vertex_weights
+        )
+        arquin.converters.write_source_graph_file(graph=circuit_graph, save_dir=self.data_dir)
+        arquin.distribute.distribute_gates(data_dir=self.data_dir)
+        gate_distribution = arquin.distribute.read_distribution_file(data_dir=self.data_dir)
+        assert len(circuit_graph) - 3 == circuit.size()
+        return gate_distribution
 
     def global_comm(self, qubit_distribution: int) -> None:
         if self.device.mv_2_dv_mapping is None:
@@ -119,6 +324,7 @@ class ModularCompiler:
             module.update_mapping()
 
     def combine(self) -> None:
+        block = qiskit.QuantumCircuit(*self.device.physical_circuit.qregs)
         for module in self.device.modules:
             device_physical_qubits = [
                 self.device.physical_circuit.qubits[
@@ -128,11 +334,21 @@ class ModularCompiler:
             ]
             print("Module {:d} --> device physical qubits {}".format(module.index,device_physical_qubits))
             print(module.physical_circuit)
-            self.device.physical_circuit.compose(
-                module.physical_circuit, qubits=device_physical_qubits, inplace=True
+            block.compose(module.physical_circuit, qubits=device_physical_qubits, inplace=True)
+        if self.seam_window > 0:
+            removed = arquin.optimize.compose_at_seam(
+                self.device.physical_circuit, block, window=self.seam_window
             )
+            print("Removed {:d} gates at the seam".format(removed))
+        else:
+            self.device.physical_circuit.compose(block, inplace=True)
         print("Combined into")
         print(self.device.physical_circuit)
         print("Depth {:d}. Size {:d}.".format(
             self.device.physical_circuit.depth(),
-            self.device.physical_circuit.size()))
\ No newline at end of file
+            self.device.physical_circuit.size()))
+        if self.report_schedule:
+            report = arquin.schedule.schedule_report(self.device.physical_circuit, self.device)
+            print("Latency {:.1f}.".format(report["latency"]))
+            print("Module idle time {}".format(report["module_idle_time"]))
+            print("Global link utilization {}".format(report["global_link_utilization"]))
\ No newline at end of file
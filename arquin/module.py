@@ -1,9 +1,26 @@
+import atexit
 import copy
+import itertools
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Optional
+
 import networkx as nx
+import numpy as np
 import qiskit
 
 import arquin
 
+OBJECTIVES = ("depth", "swaps", "latency")
+
+# Worker processes of the transpile trials, shared by all the modules and created on first use
+_trial_pool = None
+# Shared memory block name, circuit, coupling map, layout and transpile options of the compile
+# a worker process last decoded
+_trial_state = None
+
 class FrozenClass(object):
     __isfrozen = False
     def __setattr__(self, key, value):
@@ -23,40 +40,181 @@ class Module(FrozenClass):
     mp_2_dv_mapping: module to device, physical to virtual mapping
     """
 
-    def __init__(self, graph: nx.Graph, index: int) -> None:
+    def __init__(
+        self,
+        graph: nx.Graph,
+        index: int,
+        num_trials: int = 1,
+        seed: Optional[int] = None,
+        objective: str = "depth",
+        layout_method: str = "sabre",
+        routing_method: str = "sabre",
+        optimization_level: Optional[int] = None,
+        fast_path: bool = True,
+        gate_durations: Optional[Dict[str, float]] = None,
+    ) -> None:
         """
         The module graph represents the coupling map between contiguously labelled module qubits starting at
         index i=0. The module_index is used to map between module and device qubits.
+
+        num_trials: number of seeded transpile trials, run in parallel processes when more than one
+        seed: seed of the first trial, trial i uses seed + i. None for unseeded compilation.
+        objective: how to pick the best trial, one of "depth", "swaps" and "latency"
+        layout_method, routing_method, optimization_level: passed to qiskit.compiler.transpile,
+            optimization_level None for the qiskit default
+        fast_path: skip transpile on fully connected modules, tiny ones included, and only apply
+            the layout when the virtual circuit has no gates on more than two qubits
+        gate_durations: durations by gate name of the "latency" objective,
+            defaults to arquin.schedule.GATE_DURATIONS. arquin.Device passes its own.
         """
+        if objective not in OBJECTIVES:
+            raise ValueError("Unknown objective %s" % objective)
         self.graph = graph
         self.index = index
-        self.size = self.graph.size()
+        self.size = self.graph.number_of_nodes()
+        num_pairs = self.size * (self.size - 1) // 2
+        self.fully_connected = (
+            len({frozenset(edge) for edge in self.graph.edges if edge[0] != edge[1]}) == num_pairs
+        )
         self.coupling_map = arquin.converters.edges_to_coupling_map(self.graph.edges)
-        self.mv_2_dv_mapping = None
-        self.mp_2_mv_mapping = None
-        self.virtual_circuit = None
-        self.physical_circuit = None
+        self.mv_2_dv_mapping: Optional[Dict[qiskit.circuit.Qubit, qiskit.circuit.Qubit]] = None
+        self.mp_2_mv_mapping: Optional[Dict[int, qiskit.circuit.Qubit]] = None
+        self.virtual_circuit: Optional[qiskit.QuantumCircuit] = None
+        self.physical_circuit: Optional[qiskit.QuantumCircuit] = None
+        self.num_trials = num_trials
+        self.seed = seed
+        self.objective = objective
+        self.layout_method = layout_method
+        self.routing_method = routing_method
+        self.optimization_level = optimization_level
+        self.fast_path = fast_path
+        self.gate_durations = gate_durations
         self._freeze()
 
     def compile(self) -> None:
-        self.physical_circuit = qiskit.compiler.transpile(
+        """
+        Transpile the virtual circuit num_trials times and keep the best result for the objective.
+        The trials run in a process pool that is started once and reused by every compile.
+        Each worker decodes the circuit and layout from shared memory once per compile.
+        Fully connected modules take the fast path, see skips_transpile.
+        """
+        if self.skips_transpile():
+            self.physical_circuit = self._place_virtual_circuit()
+            return
+        coupling_map = qiskit.transpiler.CouplingMap(self.coupling_map)
+        transpile_options: Dict[str, Any] = {
+            "layout_method": self.layout_method,
+            "routing_method": self.routing_method,
+            "optimization_level": self.optimization_level,
+        }
+        if self.num_trials == 1:
+            self.physical_circuit = _transpile_trial(
+                self.virtual_circuit,
+                coupling_map,
+                self.mp_2_mv_mapping,
+                self.seed,
+                **transpile_options,
+            )
+            return
+        if self.seed is None:
+            seeds = np.random.randint(0, np.iinfo(np.int32).max, size=self.num_trials)
+        else:
+            seeds = self.seed + np.arange(self.num_trials)
+        try:
+            arrays = arquin.encoding.encode_circuit(self.virtual_circuit)
+            if self.mp_2_mv_mapping is not None:
+                arrays["layout"] = arquin.encoding.encode_layout(
+                    self.mp_2_mv_mapping, self.virtual_circuit
+                )
+        except ValueError:
+            # Circuits with non standard gates or symbolic parameters are pickled instead
+            arrays = {"pickled": _pickle_array((self.virtual_circuit, self.mp_2_mv_mapping))}
+        arrays["coupling_map"] = np.array(self.coupling_map, dtype=np.int64).reshape(-1, 2)
+        arrays["transpile_options"] = _pickle_array(transpile_options)
+        # The workers decode the block once per compile, every trial only sends its manifest
+        block, manifest = arquin.encoding.share_arrays(arrays)
+        try:
+            trials = list(
+                _get_trial_pool().map(
+                    _run_trial, itertools.repeat(manifest), [int(seed) for seed in seeds]
+                )
+            )
+        finally:
+            block.close()
+            block.unlink()
+        # min keeps the first of equally good trials, so a given seed always gives the same result
+        self.physical_circuit = min(trials, key=self.trial_cost)
+
+    def skips_transpile(self) -> bool:
+        """
+        Every two-qubit gate is native on a fully connected module, so the virtual circuit runs
+        as is once the layout is applied. Wider gates and classical bits still need transpile.
+        """
+        assert self.virtual_circuit is not None
+        return (
+            self.fast_path
+            and self.fully_connected
+            and self.virtual_circuit.num_clbits == 0
+            and all(len(instruction.qubits) <= 2 for instruction in self.virtual_circuit.data)
+        )
+
+    def _place_virtual_circuit(self) -> qiskit.QuantumCircuit:
+        """
+        Fast path of compile. The virtual qubits keep their physical qubit in mp_2_mv_mapping,
+        the others take the free physical qubits in order. Sets mp_2_mv_mapping directly.
+        """
+        assert self.virtual_circuit is not None
+        virtual_qubits = set(self.virtual_circuit.qubits)
+        mapping = {}
+        if self.mp_2_mv_mapping is not None:
+            mapping = {
+                module_physical_qubit: module_virtual_qubit
+                for module_physical_qubit, module_virtual_qubit in self.mp_2_mv_mapping.items()
+                if module_virtual_qubit in virtual_qubits
+            }
+        placed_qubits = set(mapping.values())
+        free_physical_qubits = (
+            module_physical_qubit
+            for module_physical_qubit in range(self.size)
+            if module_physical_qubit not in mapping
+        )
+        for module_virtual_qubit in self.virtual_circuit.qubits:
+            if module_virtual_qubit not in placed_qubits:
+                mapping[next(free_physical_qubits)] = module_virtual_qubit
+        mv_2_mp_mapping = arquin.converters.reverse_dict(mapping)
+        physical_circuit = qiskit.QuantumCircuit(self.size)
+        physical_circuit.compose(
             self.virtual_circuit,
-            coupling_map=self.coupling_map,
-            initial_layout=self.mp_2_mv_mapping,
-            layout_method="sabre",
-            routing_method="sabre",
+            qubits=[mv_2_mp_mapping[qubit] for qubit in self.virtual_circuit.qubits],
+            inplace=True,
         )
+        self.mp_2_mv_mapping = mapping
+        return physical_circuit
+
+    def trial_cost(self, physical_circuit: qiskit.QuantumCircuit) -> tuple:
+        depth = physical_circuit.depth()
+        if self.objective == "swaps":
+            return (physical_circuit.count_ops().get("swap", 0), depth)
+        elif self.objective == "latency":
+            return (arquin.schedule.circuit_latency(physical_circuit, self.gate_durations), depth)
+        return (depth, physical_circuit.size())
 
     def update_mapping(self) -> None:
         """
         Update the mapping based on the SWAPs in the circuit
         """
-        self.mp_2_mv_mapping = {}
-        for module_physical_qubit in self.physical_circuit._layout.get_physical_bits():
-            module_virtual_qubit = self.physical_circuit._layout.get_physical_bits()[
-                module_physical_qubit
-            ]
-            self.mp_2_mv_mapping[module_physical_qubit] = module_virtual_qubit
+        assert self.physical_circuit is not None
+        if self.physical_circuit._layout is None:
+            # The fast path of compile sets the mapping itself and inserts no SWAPs
+            return
+        mp_2_mv_mapping = {}
+        # Newer qiskit wraps the Layout in a TranspileLayout
+        layout = getattr(
+            self.physical_circuit._layout, "initial_layout", self.physical_circuit._layout
+        )
+        for module_physical_qubit in layout.get_physical_bits():
+            module_virtual_qubit = layout.get_physical_bits()[module_physical_qubit]
+            mp_2_mv_mapping[module_physical_qubit] = module_virtual_qubit
         physical_dag = qiskit.converters.circuit_to_dag(self.physical_circuit)
         for gate in physical_dag.topological_op_nodes():
             if gate.op.name == "swap":
@@ -64,8 +222,74 @@ class Module(FrozenClass):
                     self.physical_circuit.qubits.index(qubit) for qubit in gate.qargs
                 ]
                 module_virtual_qubits = [
-                    self.mp_2_mv_mapping[module_physical_qubit]
+                    mp_2_mv_mapping[module_physical_qubit]
                     for module_physical_qubit in module_physical_qargs
                 ]
-                self.mp_2_mv_mapping[module_physical_qargs[0]] = module_virtual_qubits[1]
-                self.mp_2_mv_mapping[module_physical_qargs[1]] = module_virtual_qubits[0]
+                mp_2_mv_mapping[module_physical_qargs[0]] = module_virtual_qubits[1]
+                mp_2_mv_mapping[module_physical_qargs[1]] = module_virtual_qubits[0]
+        self.mp_2_mv_mapping = mp_2_mv_mapping
+
+
+def _transpile_trial(
+    virtual_circuit: qiskit.QuantumCircuit,
+    coupling_map: qiskit.transpiler.CouplingMap,
+    initial_layout: Optional[dict],
+    seed: Optional[int],
+    layout_method: str = "sabre",
+    routing_method: str = "sabre",
+    optimization_level: Optional[int] = None,
+) -> qiskit.QuantumCircuit:
+    return qiskit.compiler.transpile(
+        virtual_circuit,
+        coupling_map=coupling_map,
+        initial_layout=initial_layout,
+        layout_method=layout_method,
+        routing_method=routing_method,
+        optimization_level=optimization_level,
+        seed_transpiler=seed,
+    )
+
+
+def _get_trial_pool() -> ProcessPoolExecutor:
+    global _trial_pool
+    if _trial_pool is None:
+        _trial_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count() or 1,
+            # qiskit's native thread pools do not survive a fork
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        atexit.register(_trial_pool.shutdown)
+    return _trial_pool
+
+
+def _run_trial(manifest: Dict, seed: int) -> qiskit.QuantumCircuit:
+    """manifest: shared arrays of the compile, see Module.compile"""
+    global _trial_state
+    if _trial_state is None or _trial_state[0] != manifest["name"]:
+        block, arrays = arquin.encoding.attach_arrays(manifest)
+        if "pickled" in arrays:
+            virtual_circuit, initial_layout = pickle.loads(arrays["pickled"].tobytes())
+        else:
+            virtual_circuit = arquin.encoding.decode_circuit(arrays)
+            initial_layout = None
+            if "layout" in arrays:
+                initial_layout = arquin.encoding.decode_layout(arrays["layout"], virtual_circuit)
+        coupling_map = qiskit.transpiler.CouplingMap(arrays["coupling_map"].tolist())
+        transpile_options = pickle.loads(arrays["transpile_options"].tobytes())
+        del arrays
+        block.close()
+        _trial_state = (
+            manifest["name"],
+            virtual_circuit,
+            coupling_map,
+            initial_layout,
+            transpile_options,
+        )
+    _, virtual_circuit, coupling_map, initial_layout, transpile_options = _trial_state
+    return _transpile_trial(
+        virtual_circuit, coupling_map, initial_layout, seed, **transpile_options
+    )
+
+
+def _pickle_array(obj: object) -> np.ndarray:
+    return np.frombuffer(pickle.dumps(obj), dtype=np.uint8)
@@ -0,0 +1,198 @@
+"""
+Peephole optimization across the seams between recursions.
+Each recursion appends a freshly routed block to Device.physical_circuit. Gates at the end of the
+circuit and at the start of the block may cancel (e.g. back-to-back SWAPs) or merge, but qiskit
+never sees them together. Only the last/first `window` gates on every qubit are looked at.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, List
+
+import numpy as np
+import qiskit
+
+SELF_INVERSE = {"x", "y", "z", "h", "cx", "cy", "cz", "ch", "swap"}
+INVERSE_PAIRS = {
+    ("s", "sdg"),
+    ("sdg", "s"),
+    ("t", "tdg"),
+    ("tdg", "t"),
+    ("sx", "sxdg"),
+    ("sxdg", "sx"),
+}
+# Gates whose angles add up when applied back to back on the same qubits
+ROTATIONS = {"rx", "ry", "rz", "p", "u1", "rxx", "ryy", "rzz", "crx", "cry", "crz", "cp"}
+# Gates that do not care about the order of their qubits
+SYMMETRIC = {"swap", "cz", "cp", "rxx", "ryy", "rzz"}
+DIAGONAL = {"z", "s", "sdg", "t", "tdg", "rz", "p", "u1", "cz", "cp", "crz", "rzz"}
+X_AXIS = {"x", "sx", "sxdg", "rx"}
+
+
+def compose_at_seam(
+    circuit: qiskit.QuantumCircuit, block: qiskit.QuantumCircuit, window: int = 8
+) -> int:
+    """
+    Append block to circuit in place, cancelling and merging gates across the seam.
+    Both circuits must be defined on the same qubits.
+    Returns the number of gates removed.
+    """
+    qubit_to_idx = {qubit: idx for idx, qubit in enumerate(circuit.qubits)}
+    tail = _seam_region(circuit.data, qubit_to_idx, window, reverse=True)
+    front = _seam_region(block.data, qubit_to_idx, window, reverse=False)
+    gates = [
+        _Gate(circuit.data[idx], qubit_to_idx, source=0, position=idx) for idx in sorted(tail)
+    ] + [_Gate(block.data[idx], qubit_to_idx, source=1, position=idx) for idx in sorted(front)]
+    kept = cancel_gates(gates)
+
+    kept_tail = {gate.position: gate for gate in kept if gate.source == 0}
+    for idx in sorted(tail, reverse=True):
+        if idx not in kept_tail:
+            del circuit.data[idx]
+        elif kept_tail[idx].changed:
+            circuit.data[idx] = kept_tail[idx].instruction()
+    kept_front = {gate.position: gate for gate in kept if gate.source == 1}
+    for idx, instruction in enumerate(block.data):
+        if idx in kept_front:
+            instruction = kept_front[idx].instruction()
+        elif idx in front:
+            continue
+        circuit.append(instruction.operation, instruction.qubits, instruction.clbits)
+    return len(gates) - len(kept)
+
+
+def cancel_gates(gates: List[_Gate]) -> List[_Gate]:
+    """
+    Commutation-aware cancellation over a list of gates in circuit order.
+    Every gate looks back, past the gates it commutes with, for a gate it cancels or merges with.
+    """
+    kept: List[_Gate] = []
+    for gate in gates:
+        for position in range(len(kept) - 1, -1, -1):
+            other = kept[position]
+            if not set(other.qubits) & set(gate.qubits):
+                continue
+            if _cancels(other, gate):
+                del kept[position]
+                break
+            if _merges(other, gate):
+                other.params = [a + b for a, b in zip(other.params, gate.params)]
+                other.changed = True
+                # Rotations by multiples of 4 pi are the identity, also when controlled
+                angles = np.mod(np.array(other.params) + 2 * np.pi, 4 * np.pi) - 2 * np.pi
+                if np.allclose(angles, 0):
+                    del kept[position]
+                break
+            if not _commutes(other, gate):
+                kept.append(gate)
+                break
+        else:
+            kept.append(gate)
+    return kept
+
+
+class _Gate:
+    def __init__(
+        self,
+        instruction: qiskit.circuit.CircuitInstruction,
+        qubit_to_idx: Dict,
+        source: int,
+        position: int,
+    ) -> None:
+        self.original = instruction
+        self.name = instruction.operation.name
+        self.params = list(instruction.operation.params)
+        self.qubits = tuple(qubit_to_idx[qubit] for qubit in instruction.qubits)
+        self.unitary = (
+            len(instruction.clbits) == 0
+            and getattr(instruction.operation, "condition", None) is None
+            and self.name not in ("measure", "reset", "barrier", "delay")
+        )
+        self.source = source
+        self.position = position
+        self.changed = False
+
+    def instruction(self) -> qiskit.circuit.CircuitInstruction:
+        if not self.changed:
+            return self.original
+        operation = self.original.operation.copy()
+        operation.params = self.params
+        return self.original.replace(operation=operation)
+
+
+def _same_qubits(gate_a: _Gate, gate_b: _Gate) -> bool:
+    if gate_a.name in SYMMETRIC:
+        return sorted(gate_a.qubits) == sorted(gate_b.qubits)
+    return gate_a.qubits == gate_b.qubits
+
+
+def _cancels(gate_a: _Gate, gate_b: _Gate) -> bool:
+    if not (gate_a.unitary and gate_b.unitary and _same_qubits(gate_a, gate_b)):
+        return False
+    if gate_a.name == gate_b.name and gate_a.name in SELF_INVERSE:
+        return True
+    return (gate_a.name, gate_b.name) in INVERSE_PAIRS
+
+
+def _merges(gate_a: _Gate, gate_b: _Gate) -> bool:
+    return (
+        gate_a.unitary
+        and gate_b.unitary
+        and gate_a.name == gate_b.name
+        and gate_a.name in ROTATIONS
+        and _same_qubits(gate_a, gate_b)
+        and all(isinstance(param, (int, float)) for param in gate_a.params + gate_b.params)
+    )
+
+
+def _commutes(gate_a: _Gate, gate_b: _Gate) -> bool:
+    """Conservative commutation rules for gates sharing qubits"""
+    if not (gate_a.unitary and gate_b.unitary):
+        return False
+    if gate_a.name in DIAGONAL and gate_b.name in DIAGONAL:
+        return True
+    if gate_a.name == "cx":
+        return _commutes_with_cx(gate_b, gate_a)
+    if gate_b.name == "cx":
+        return _commutes_with_cx(gate_a, gate_b)
+    return False
+
+
+def _commutes_with_cx(gate: _Gate, cx: _Gate) -> bool:
+    control, target = cx.qubits
+    for qubit in set(gate.qubits) & {control, target}:
+        if gate.name == "cx":
+            # CXs commute when they only share controls or only share targets
+            if gate.qubits.index(qubit) != cx.qubits.index(qubit):
+                return False
+        elif qubit == control and gate.name not in DIAGONAL:
+            return False
+        elif qubit == target and gate.name not in X_AXIS:
+            return False
+    return True
+
+
+def _seam_region(data: List, qubit_to_idx: Dict, window: int, reverse: bool) -> set:
+    """
+    Indices of the last (reverse) or first `window` gates on every qubit.
+    The region is closed, nothing outside of it sits between the seam and a gate inside it.
+    """
+    num_qubits = len(qubit_to_idx)
+    counts = np.zeros(num_qubits, dtype=int)
+    closed = np.zeros(num_qubits, dtype=bool)
+    region = set()
+    indices = range(len(data) - 1, -1, -1) if reverse else range(len(data))
+    for scanned, idx in enumerate(indices):
+        if closed.all() or scanned >= window * num_qubits:
+            break
+        instruction = data[idx]
+        qubits = [qubit_to_idx[qubit] for qubit in instruction.qubits]
+        if len(instruction.clbits) > 0 or len(qubits) == 0:
+            closed[qubits] = True
+            continue
+        if closed[qubits].any() or (counts[qubits] >= window).any():
+            closed[qubits] = True
+            continue
+        counts[qubits] += 1
+        region.add(idx)
+    return region
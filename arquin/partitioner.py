@@ -0,0 +1,137 @@
+"""
+Long-lived partitioner worker process.
+The worker keeps the target architecture of one device loaded and partitions the circuit gate
+arrays it receives over a pipe, so neither the target nor the worker is set up per recursion.
+"""
+
+from __future__ import annotations
+
+import multiprocessing
+import shutil
+import tempfile
+import threading
+from typing import Optional
+
+import numpy as np
+
+import arquin
+
+BACKENDS = ("native", "scotch")
+
+
+class PartitionerService:
+    """
+    Partition the gates of circuits onto the modules of a device in a worker process.
+
+    backend: "native" runs arquin.distribute.partition_gate_arrays in the worker, without any
+        process startup or file I/O per request. It only uses the module sizes and ignores the
+        global edges, i.e. the distances between the modules.
+        "scotch" builds the SCOTCH target architecture once with amk_grf, then runs gmap on the
+        gate dependency graph in the worker's private directory for every request.
+    The service can be shared by all the ModularCompiler runs on the same device, also from
+    several threads. Requests are served one at a time.
+    """
+
+    def __init__(self, device: arquin.device.Device, backend: str = "native") -> None:
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend %s" % backend)
+        self.backend = backend
+        capacities = np.array([module.size for module in device.modules])
+        device_edges = np.array(list(device.coarse_graph.edges()), dtype=int).reshape(-1, 2)
+        context = multiprocessing.get_context("spawn")
+        self._connection, worker_connection = context.Pipe()
+        self._process = context.Process(
+            target=_serve,
+            args=(worker_connection, backend, device_edges, capacities),
+            daemon=True,
+        )
+        self._process.start()
+        worker_connection.close()
+        # One request and its reply at a time on the pipe
+        self._lock = threading.Lock()
+
+    def partition(
+        self,
+        wire_offsets: np.ndarray,
+        wires: np.ndarray,
+        num_qubits: int,
+        lookahead: Optional[int] = None,
+    ) -> np.ndarray:
+        """
+        Module index of every gate of the CSR gate arrays of arquin.converters,
+        same as arquin.distribute.read_distribution_file
+        lookahead: number of ASAP layers in the qubit interaction graph of the "native" backend
+        """
+        request = (np.asarray(wire_offsets), np.asarray(wires), num_qubits, lookahead)
+        with self._lock:
+            self._connection.send(request)
+            result = self._connection.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self) -> None:
+        with self._lock:
+            if self._process.is_alive():
+                self._connection.send(None)
+                self._process.join()
+        self._connection.close()
+
+    def __enter__(self) -> PartitionerService:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def _serve(
+    connection: multiprocessing.connection.Connection,
+    backend: str,
+    device_edges: np.ndarray,
+    capacities: np.ndarray,
+) -> None:
+    work_dir = None
+    if backend == "scotch":
+        work_dir = tempfile.mkdtemp(prefix="arquin_partitioner_")
+        device_graph = arquin.converters.edges_to_source_graph(
+            edges=[tuple(edge) for edge in device_edges], vertex_weights=None
+        )
+        arquin.converters.write_target_graph_file(graph=device_graph, save_dir=work_dir)
+    try:
+        while True:
+            request = connection.recv()
+            if request is None:
+                break
+            try:
+                connection.send(_partition(backend, work_dir, capacities, *request))
+            except Exception as error:
+                connection.send(error)
+    finally:
+        connection.close()
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _partition(
+    backend: str,
+    work_dir: Optional[str],
+    capacities: np.ndarray,
+    wire_offsets: np.ndarray,
+    wires: np.ndarray,
+    num_qubits: int,
+    lookahead: Optional[int],
+) -> np.ndarray:
+    if backend == "native":
+        _, gate_distribution = arquin.distribute.partition_gate_arrays(
+            wire_offsets, wires, num_qubits, module_sizes=capacities, lookahead=lookahead
+        )
+        return gate_distribution
+    vertex_weights, edges = arquin.converters.gate_arrays_to_graph(
+        wire_offsets, wires, num_qubits=num_qubits
+    )
+    circuit_graph = arquin.converters.edges_to_source_graph(
+        edges=edges, vertex_weights=vertex_weights
+    )
+    arquin.converters.write_source_graph_file(graph=circuit_graph, save_dir=work_dir)
+    arquin.distribute.distribute_gates(data_dir=work_dir)
+    return arquin.distribute.read_distribution_file(data_dir=work_dir)
@@ -0,0 +1,136 @@
+"""
+Latency-aware ASAP/ALAP scheduling of circuits in a single pass over the instruction list.
+Gate durations come from the device, two-qubit gates over a global edge are slowed down by the
+slowdown of that link.
+"""
+
+from __future__ import annotations
+
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import qiskit
+
+import arquin
+
+# Durations by gate name, the other gates get DURATIONS_BY_SIZE by their number of qubits
+GATE_DURATIONS = {"swap": 30.0, "measure": 100.0, "reset": 100.0, "barrier": 0.0}
+DURATIONS_BY_SIZE = {1: 1.0, 2: 10.0}
+GLOBAL_EDGE_SLOWDOWN = 10.0
+
+
+def gate_durations(
+    circuit: qiskit.QuantumCircuit,
+    durations: Optional[Dict[str, float]] = None,
+    link_slowdowns: Optional[Dict[Tuple[int, int], float]] = None,
+) -> np.ndarray:
+    """
+    Duration of every instruction in circuit.data.
+    link_slowdowns: slowdown factors of two-qubit gates, keyed by sorted pairs of qubit indices
+    """
+    if durations is None:
+        durations = GATE_DURATIONS
+    if link_slowdowns is None:
+        link_slowdowns = {}
+    qubit_to_idx = {qubit: idx for idx, qubit in enumerate(circuit.qubits)}
+    instruction_durations = np.zeros(len(circuit.data))
+    for gate_idx, instruction in enumerate(circuit.data):
+        name = instruction.operation.name
+        num_qubits = len(instruction.qubits)
+        if name in durations:
+            duration = durations[name]
+        else:
+            duration = DURATIONS_BY_SIZE.get(num_qubits, DURATIONS_BY_SIZE[2])
+        if num_qubits == 2 and link_slowdowns:
+            qubit_a, qubit_b = sorted(qubit_to_idx[qubit] for qubit in instruction.qubits)
+            duration *= link_slowdowns.get((qubit_a, qubit_b), 1.0)
+        instruction_durations[gate_idx] = duration
+    return instruction_durations
+
+
+def asap_schedule(
+    wire_offsets: np.ndarray, wires: np.ndarray, durations: np.ndarray, num_wires: int
+) -> np.ndarray:
+    """Earliest start time of every gate, the gates of wires[i] use the CSR layout of converters"""
+    ready_times = np.zeros(num_wires)
+    start_times = np.zeros(len(durations))
+    for gate_idx in range(len(durations)):
+        gate_wires = wires[wire_offsets[gate_idx] : wire_offsets[gate_idx + 1]]
+        if len(gate_wires) == 0:
+            continue
+        start_times[gate_idx] = ready_times[gate_wires].max()
+        ready_times[gate_wires] = start_times[gate_idx] + durations[gate_idx]
+    return start_times
+
+
+def alap_schedule(
+    wire_offsets: np.ndarray, wires: np.ndarray, durations: np.ndarray, num_wires: int
+) -> np.ndarray:
+    """Latest start time of every gate that does not extend the critical path"""
+    asap_starts = asap_schedule(wire_offsets, wires, durations, num_wires)
+    latency = (asap_starts + durations).max() if len(durations) > 0 else 0.0
+    deadlines = np.full(num_wires, latency)
+    start_times = np.zeros(len(durations))
+    for gate_idx in range(len(durations) - 1, -1, -1):
+        gate_wires = wires[wire_offsets[gate_idx] : wire_offsets[gate_idx + 1]]
+        if len(gate_wires) == 0:
+            start_times[gate_idx] = latency - durations[gate_idx]
+            continue
+        start_times[gate_idx] = deadlines[gate_wires].min() - durations[gate_idx]
+        deadlines[gate_wires] = start_times[gate_idx]
+    return start_times
+
+
+def schedule_report(circuit: qiskit.QuantumCircuit, device: arquin.device.Device) -> Dict:
+    """
+    Schedule a device physical circuit, e.g. Device.physical_circuit, and report:
+    latency: length of the critical path
+    critical_gates: number of gates without slack between their ASAP and ALAP start times
+    module_idle_time: per module, summed over its qubits, the time a qubit is not busy
+    global_link_utilization: per global edge, the fraction of the latency it is busy
+    """
+    link_slowdowns = device.global_edge_slowdowns
+    durations = gate_durations(circuit, device.gate_durations, link_slowdowns)
+    wire_offsets, wires = arquin.converters.circuit_to_gate_arrays(circuit)
+    num_wires = circuit.num_qubits + circuit.num_clbits
+    asap_starts = asap_schedule(wire_offsets, wires, durations, num_wires)
+    alap_starts = alap_schedule(wire_offsets, wires, durations, num_wires)
+    latency = float((asap_starts + durations).max()) if len(durations) > 0 else 0.0
+
+    gate_indices = np.repeat(np.arange(len(durations)), np.diff(wire_offsets))
+    busy_times = np.bincount(wires, weights=durations[gate_indices], minlength=num_wires)
+    idle_times = latency - busy_times[: circuit.num_qubits]
+    module_idle_time = np.zeros(len(device.modules))
+    for device_physical_qubit in range(min(circuit.num_qubits, device.size)):
+        module_index, _ = device.dp_2_mp_mapping[device_physical_qubit]
+        module_idle_time[module_index] += idle_times[device_physical_qubit]
+
+    link_busy_times = {link: 0.0 for link in link_slowdowns}
+    two_qubit_gates = np.flatnonzero(np.diff(wire_offsets) == 2)
+    for gate_idx in two_qubit_gates:
+        pair = tuple(sorted(wires[wire_offsets[gate_idx] : wire_offsets[gate_idx + 1]]))
+        if pair in link_busy_times:
+            link_busy_times[pair] += durations[gate_idx]
+    return {
+        "latency": latency,
+        "critical_gates": int(np.sum(np.isclose(asap_starts, alap_starts))),
+        "module_idle_time": module_idle_time,
+        "global_link_utilization": {
+            link: float(busy_time / latency) if latency > 0 else 0.0
+            for link, busy_time in link_busy_times.items()
+        },
+    }
+
+
+def circuit_latency(
+    circuit: qiskit.QuantumCircuit, durations: Optional[Dict[str, float]] = None
+) -> float:
+    """Length of the critical path of a circuit, without global edges"""
+    wire_offsets, wires = arquin.converters.circuit_to_gate_arrays(circuit)
+    instruction_durations = gate_durations(circuit, durations)
+    start_times = asap_schedule(
+        wire_offsets, wires, instruction_durations, circuit.num_qubits + circuit.num_clbits
+    )
+    if len(instruction_durations) == 0:
+        return 0.0
+    return float((start_times + instruction_durations).max())
@@ -1,41 +1,74 @@
 from __future__ import annotations
 
-from typing import Dict, List
-import qiskit, random
+from typing import Dict, List, Optional
+import qiskit
 from qiskit.dagcircuit.dagnode import DAGInNode, DAGOutNode, DAGOpNode
 import matplotlib.pyplot as plt
 import networkx as nx
 import numpy as np
 
-from qiskit_helper_functions.non_ibmq_functions import circuit_stripping
 import arquin
 
 
-def overlapped(node, pos):
-    for other_node in pos:
-        if other_node != node and np.allclose(pos[node], pos[other_node], atol=0.1, rtol=1e-1):
-            return True
-    return False
-
-
-def find_op_node(dag, qargs):
-    qubits = dag.qubits
-    qubit_op_counter = [0 for _ in range(dag.num_qubits())]
+def resolve_overlaps(
+    positions: np.ndarray,
+    min_distance: float = 0.1,
+    seed: Optional[int] = None,
+    max_rounds: int = 100,
+) -> np.ndarray:
+    """
+    Jitter the positions closer than min_distance in both coordinates to another position.
+    Close pairs are found with a KD-tree, the later position of every pair is moved.
+    """
+    # scipy comes with qiskit, imported here so that compiling never pays for it
+    from scipy.spatial import cKDTree
+
+    positions = np.array(positions, dtype=float).reshape(-1, 2)
+    rng = np.random.default_rng(seed)
+    for _ in range(max_rounds):
+        pairs = cKDTree(positions).query_pairs(r=min_distance, p=np.inf, output_type="ndarray")
+        if len(pairs) == 0:
+            break
+        moved = np.unique(pairs.max(axis=1))
+        positions[moved] += rng.uniform(-0.5, 0.5, size=(len(moved), 2))
+    return positions
+
+
+def op_node_index(dag: qiskit.dagcircuit.DAGCircuit) -> Dict[tuple, DAGOpNode]:
+    """
+    Index the multi-qubit op nodes of a DAG in one topological pass, for find_op_node.
+    The key of a node is its tuple of (qubit index, number of earlier multi-qubit op nodes on the
+    qubit) for every qarg.
+    """
+    qubit_to_idx = {qubit: idx for idx, qubit in enumerate(dag.qubits)}
+    qubit_op_counter = np.zeros(dag.num_qubits(), dtype=int)
+    index: Dict[tuple, DAGOpNode] = {}
     for op_node in dag.topological_op_nodes():
         if len(op_node.qargs) > 1:
-            op_node_qargs = [
-                (qubits.index(qarg), qubit_op_counter[qubits.index(qarg)]) for qarg in op_node.qargs
-            ]
-            if op_node_qargs == qargs:
-                return op_node
-            else:
-                for qarg in op_node.qargs:
-                    qubit_op_counter[qubits.index(qarg)] += 1
-    return None
+            qarg_indices = [qubit_to_idx[qarg] for qarg in op_node.qargs]
+            key = tuple((idx, int(qubit_op_counter[idx])) for idx in qarg_indices)
+            index.setdefault(key, op_node)
+            qubit_op_counter[qarg_indices] += 1
+    return index
+
+
+def find_op_node(
+    dag: qiskit.dagcircuit.DAGCircuit,
+    qargs: List,
+    index: Optional[Dict[tuple, DAGOpNode]] = None,
+) -> Optional[DAGOpNode]:
+    """
+    Multi-qubit op node with the given [(qubit index, op counter)] qargs, None if there is none.
+    index: op_node_index of the dag, pass it to look up many nodes in O(1) each
+    """
+    if index is None:
+        index = op_node_index(dag)
+    return index.get(tuple(tuple(qarg) for qarg in qargs))
 
 
 def draw_cut_edges(graph, pos, cut_points):
     ax = plt.gca()
+    cut_points = set(cut_points)
     for e in graph.edges:
         cut_edge = e[:2] in cut_points
         color = "red" if cut_edge else "black"
@@ -67,22 +100,20 @@ def draw_cut_edges(graph, pos, cut_points):
 def get_node_pos(graph, layout_name):
     layout_method = getattr(nx, layout_name)
     pos = layout_method(graph)
-    node_pos = {}
-    for node in pos:
-        node_pos[node] = pos[node]
-        while overlapped(node, node_pos):
-            node_pos[node] += [random.uniform(-0.5, 0.5) for _ in range(2)]
-    return node_pos
+    nodes = list(pos)
+    positions = resolve_overlaps(np.array([pos[node] for node in nodes]))
+    return dict(zip(nodes, positions))
 
 
 def get_node_labels(graph, qubits):
+    qubit_to_idx = {qubit: idx for idx, qubit in enumerate(qubits)}
     op_node_counter = 0
     node_labels = {}
     for node in graph.nodes:
         if type(node) is DAGInNode:
-            node_labels[node] = "q%d" % qubits.index(node.wire)
+            node_labels[node] = "q%d" % qubit_to_idx[node.wire]
         elif type(node) is DAGOutNode:
-            node_labels[node] = "q%d" % qubits.index(node.wire)
+            node_labels[node] = "q%d" % qubit_to_idx[node.wire]
         elif type(node) is DAGOpNode:
             node_labels[node] = "%s%d" % (node.op.name, op_node_counter)
             op_node_counter += 1
@@ -104,50 +135,103 @@ def get_node_colors(graph, qubits):
 def plot_recursion(
     recursion_counter: int,
     device: arquin.device.Device,
-    remaining_virtual_circuit: qiskit.QuantumCircuit,
-    distribution: List,
-    output_circuit: qiskit.QuantumCircuit,
+    virtual_circuit: qiskit.QuantumCircuit,
+    gate_distribution: np.ndarray,
+    save_dir: str,
+    max_gates: int = 2000,
 ) -> None:
+    """
+    Save a compact summary of one recursion to save_dir/recursion_<recursion_counter>.pdf:
+    a heatmap of the module of every gate over the qubits and ASAP layers of virtual_circuit,
+    and the modules with their loads and the dependency edges cut between them.
+    Only the first max_gates gates are drawn.
+    """
+    wire_offsets, wires = arquin.converters.circuit_to_gate_arrays(virtual_circuit)
+    num_qubits = virtual_circuit.num_qubits
+    num_modules = len(device.modules)
+    gate_distribution = np.asarray(gate_distribution)
+    vertex_weights, edges = arquin.converters.gate_arrays_to_graph(
+        wire_offsets, wires, num_qubits=num_qubits
+    )
+    loads = arquin.metrics.module_loads(gate_distribution, vertex_weights, num_modules)
+    cut = gate_distribution[edges[:, 0]] != gate_distribution[edges[:, 1]]
+    cut_counts = np.zeros((num_modules, num_modules), dtype=int)
+    np.add.at(
+        cut_counts,
+        (
+            np.minimum(gate_distribution[edges[cut, 0]], gate_distribution[edges[cut, 1]]),
+            np.maximum(gate_distribution[edges[cut, 0]], gate_distribution[edges[cut, 1]]),
+        ),
+        1,
+    )
 
-    # stripped_remaining_virtual = circuit_stripping(remaining_virtual_circuit)
-    # remaining_virtual_dag = qiskit.converters.circuit_to_dag(stripped_remaining_virtual)
-    # remaining_virtual_graph = remaining_virtual_dag.to_networkx()
-    # node_pos = get_node_pos(remaining_virtual_graph, layout_name='planar_layout')
-    # node_labels = get_node_labels(remaining_virtual_graph, qubits=remaining_virtual_circuit.qubits)
-    # node_colors = get_node_colors(remaining_virtual_graph, qubits=remaining_virtual_circuit.qubits)
-    # nx.draw_networkx_nodes(remaining_virtual_graph, node_color=node_colors, pos=node_pos, node_shape='o', node_size=700)
-    # nx.draw_networkx_labels(remaining_virtual_graph, labels=node_labels, pos=node_pos)
-    # draw_cut_edges(graph=remaining_virtual_graph, pos=node_pos, cut_points=[])
-    # plt.axis("off")
-    # plt.savefig("./workspace/remaining_virtual_circuit_%d.pdf" % recursion_counter, format='pdf')
-    # plt.close()
-
-    remaining_virtual_circuit.draw(
-        output="mpl",
-        fold=500,
-        filename="./workspace/remaining_virtual_circuit_%d.pdf" % recursion_counter,
+    num_drawn = min(len(gate_distribution), max_gates)
+    qubit_offsets, qubits = arquin.converters._qubit_arrays(
+        wire_offsets[: num_drawn + 1], wires, num_qubits
     )
-    plt.close()
-
-    # remaining_virtual_dag = qiskit.converters.circuit_to_dag(remaining_virtual_circuit)
-    # remaining_virtual_dag.draw(
-    #     filename="./workspace/remaining_virtual_dag_%d.pdf" % recursion_counter, style="color"
-    # )
-    # plt.close()
-
-    for module in device.modules:
-        module.virtual_circuit.draw(
-            output="mpl",
-            fold=500,
-            filename="./workspace/module_%d_virtual_%d.pdf"
-            % (module.module_index, recursion_counter),
-        )
-        module.physical_circuit.draw(
-            output="mpl",
-            fold=500,
-            filename="./workspace/module_%d_physical_%d.pdf"
-            % (module.module_index, recursion_counter),
-        )
-    output_circuit.draw(
-        output="mpl", fold=500, filename="./workspace/output_%d.pdf" % recursion_counter
+    layers = np.zeros(num_drawn, dtype=int)
+    qubit_depth = np.zeros(num_qubits, dtype=int)
+    for gate_idx in range(num_drawn):
+        gate_qubits = qubits[qubit_offsets[gate_idx] : qubit_offsets[gate_idx + 1]]
+        if len(gate_qubits) > 0:
+            layers[gate_idx] = qubit_depth[gate_qubits].max()
+            qubit_depth[gate_qubits] = layers[gate_idx] + 1
+    heatmap = np.full((num_qubits, max(qubit_depth.max(initial=0), 1)), -1)
+    gate_indices = np.repeat(np.arange(num_drawn), np.diff(qubit_offsets))
+    heatmap[qubits[: qubit_offsets[-1]], layers[gate_indices]] = gate_distribution[gate_indices]
+
+    figure, (heatmap_ax, graph_ax) = plt.subplots(
+        1, 2, figsize=(12, 4), gridspec_kw={"width_ratios": [3, 1]}
+    )
+    image = heatmap_ax.imshow(
+        np.ma.masked_less(heatmap, 0),
+        aspect="auto",
+        interpolation="nearest",
+        cmap=plt.get_cmap("tab10", num_modules),
+        vmin=-0.5,
+        vmax=num_modules - 0.5,
+    )
+    figure.colorbar(image, ax=heatmap_ax, ticks=range(num_modules), label="Module")
+    heatmap_ax.set_xlabel("ASAP layer")
+    heatmap_ax.set_ylabel("Qubit")
+    heatmap_ax.set_title(
+        "Recursion %d: %d/%d gates, %d cut edges"
+        % (recursion_counter, num_drawn, len(gate_distribution), cut.sum())
+    )
+
+    graph = nx.Graph(device.coarse_graph)
+    graph.add_nodes_from(range(num_modules))
+    pos = get_node_pos(graph, layout_name="circular_layout")
+    nx.draw_networkx_edges(graph, pos=pos, ax=graph_ax, edge_color="lightgray", width=4)
+    cut_graph = nx.Graph()
+    for module_a, module_b in zip(*np.nonzero(cut_counts)):
+        cut_graph.add_edge(module_a, module_b, weight=cut_counts[module_a, module_b])
+    nx.draw_networkx_edges(
+        cut_graph,
+        pos=pos,
+        ax=graph_ax,
+        edge_color="red",
+        width=[
+            1 + 4 * weight / cut_counts.max() for _, _, weight in cut_graph.edges(data="weight")
+        ],
+    )
+    nx.draw_networkx_edge_labels(
+        cut_graph, pos=pos, ax=graph_ax, edge_labels=nx.get_edge_attributes(cut_graph, "weight")
+    )
+    nx.draw_networkx_nodes(graph, pos=pos, ax=graph_ax, node_color="royalblue", node_size=700)
+    nx.draw_networkx_labels(
+        graph,
+        pos=pos,
+        ax=graph_ax,
+        labels={
+            module.index: "%d\n%d/%d" % (module.index, loads[module.index], module.size)
+            for module in device.modules
+        },
+        font_color="white",
+        font_size=8,
     )
+    graph_ax.set_title("Module loads and cut edges")
+    graph_ax.axis("off")
+    figure.tight_layout()
+    figure.savefig("%s/recursion_%d.pdf" % (save_dir, recursion_counter))
+    plt.close(figure)
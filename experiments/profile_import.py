@@ -0,0 +1,33 @@
+"""
+Import time of the arquin package, each statement timed in a fresh interpreter.
+Run from the repository root: python experiments/profile_import.py
+"""
+
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+STATEMENTS = {
+    "python": "pass",
+    "arquin": "import arquin",
+    "compiler": "import arquin; arquin.ModularCompiler; arquin.distribute",
+    "ingest": "import arquin; arquin.ingest",
+    "device plot": "import arquin; arquin.Device; import matplotlib.pyplot",
+    "visualize": "import arquin; arquin.visualize",
+}
+
+
+def time_statement(statement, repeats):
+    times = []
+    for _ in range(repeats):
+        begin = perf_counter()
+        subprocess.run([sys.executable, "-c", statement], check=True)
+        times.append(perf_counter() - begin)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    repeats = 5
+    for name, statement in STATEMENTS.items():
+        print("{:<12s} {:.3f} s".format(name, time_statement(statement, repeats)), flush=True)
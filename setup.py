@@ -20,7 +20,7 @@ setup(
     url="",
     author="Wei Tang and Teague Tomesh",
     author_email="ttomesh@princeton.edu",
-    python_requires=(">=3.7.0"),
+    python_requires=(">=3.8.0"),
     install_requires=requirements,
     extras_require={},
     license="N/A",